@@ -49,6 +49,7 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'core.profiling.QueryProfilingMiddleware',
 ]
 
 ROOT_URLCONF = 'cal_sync.urls'
@@ -78,6 +79,20 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        'OPTIONS': {
+            # WAL lets the web process read while a poll writes. NORMAL only
+            # syncs at checkpoints, which is still durable against crashes of the app.
+            'init_command': 'PRAGMA journal_mode=WAL; PRAGMA synchronous=NORMAL',
+            # Seconds a connection waits for the write lock (busy timeout)
+            'timeout': 20,
+            # Take the write lock when a transaction starts. Upgrading a read
+            # transaction fails at once with "database is locked", without waiting.
+            'transaction_mode': 'IMMEDIATE',
+        },
+        'TEST': {
+            # On disk, so concurrent test threads use separate connections like real pollers
+            'NAME': BASE_DIR / 'test_db.sqlite3',
+        },
     }
 }
 
@@ -125,4 +140,33 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 
 LOGIN_REDIRECT_URL = '/app/dashboard/'
-LOGOUT_REDIRECT_URL = '/accounts/login/'
\ No newline at end of file
+LOGOUT_REDIRECT_URL = '/accounts/login/'
+
+# Sync instrumentation
+# JSON run report written by poll_sheet and exposed by the metrics view
+SYNC_METRICS_FILE = BASE_DIR / 'sync_metrics.json'
+# Bearer token for scraping /app/metrics/ without a staff login
+METRICS_TOKEN = os.environ.get('CAL_SYNC_METRICS_TOKEN')
+
+# One JSON line per row and CalDAV operation of every poll, rotate it externally (e.g. logrotate)
+SYNC_RUN_LOG_FILE = BASE_DIR / 'sync_runs.jsonl'
+
+# Per row/user/request query and HTTP profiling, also enabled by CAL_SYNC_PROFILE=1
+SYNC_PROFILING = False
+
+# Google Drive change notifications, see the sync_sheet_sources command
+# Public HTTPS URL of the drive_notifications view, channels are only opened when set
+DRIVE_WEBHOOK_URL = os.environ.get('CAL_SYNC_DRIVE_WEBHOOK_URL')
+# Drive caps file channels at one day
+DRIVE_CHANNEL_TTL_SECONDS = 60 * 60 * 24
+# Quiet time after the last notification before a sheet is synced
+SHEET_NOTIFICATION_DEBOUNCE_SECONDS = 30
+# Full poll of every sheet this often, in case notifications were lost
+SHEET_FALLBACK_POLL_SECONDS = 60 * 60 * 6
+
+# Run lease of poll_sheet per spreadsheet, renewed while the run progresses.
+# A crashed run blocks the sheet for at most this long.
+SYNC_LEASE_SECONDS = 15 * 60
+
+# Concurrent keep-alive connections per user calendar for batched CalDAV writes
+CALDAV_BATCH_WORKERS = 4
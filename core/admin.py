@@ -1,8 +1,154 @@
 from django.contrib import admin
+from django.core.paginator import Paginator
+from django.db import connections
+from django.utils.functional import cached_property
 from .models import UserProfile, SheetEvent, UserEventBinding, CalendarConfig, UserCalDAVEvent
+from .tasks import (enqueue_admin_action, purge_sheet_events, purge_user_caldav_events,
+                    resync_sheet_events, resync_user_caldav_events)
 
-admin.site.register(UserProfile)
-admin.site.register(SheetEvent)
-admin.site.register(UserEventBinding)
-admin.site.register(CalendarConfig)
-admin.site.register(UserCalDAVEvent)
+# Below this many rows COUNT(*) is cheap enough to be exact
+ESTIMATED_COUNT_THRESHOLD = 10000
+
+
+def estimated_row_count(model, using='default'):
+    """Row count of the model's table from database statistics, None if unknown."""
+    connection = connections[using]
+    table = model._meta.db_table
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            cursor.execute('SELECT reltuples::bigint FROM pg_class WHERE oid = %s::regclass', [table])
+        elif connection.vendor == 'mysql':
+            cursor.execute('SELECT table_rows FROM information_schema.tables '
+                           'WHERE table_schema = DATABASE() AND table_name = %s', [table])
+        elif connection.vendor == 'sqlite':
+            # Reads the end of the primary key index, overestimates after deletions
+            cursor.execute(f'SELECT MAX(rowid) FROM {connection.ops.quote_name(table)}')
+        else:
+            return None
+        row = cursor.fetchone()
+    # PostgreSQL reports -1 before the table was first analyzed
+    if row is None or row[0] is None or row[0] < 0:
+        return None
+    return row[0]
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Uses the estimated table size for unfiltered change lists of large
+    tables, filtered ones are counted exactly.
+    """
+
+    @cached_property
+    def count(self):
+        query = getattr(self.object_list, 'query', None)
+        if query is not None and not query.where:
+            estimate = estimated_row_count(self.object_list.model, self.object_list.db)
+            if estimate is not None and estimate > ESTIMATED_COUNT_THRESHOLD:
+                return estimate
+        return super().count
+
+
+class UserListFilter(admin.SimpleListFilter):
+    """Filters by user profile, with the choices read in one query."""
+    title = 'user'
+    parameter_name = 'user_profile'
+
+    def lookups(self, request, model_admin):
+        return UserProfile.objects.order_by('user__username').values_list('pk', 'user__username')
+
+    def queryset(self, request, queryset):
+        if self.value():
+            return queryset.filter(user_profile_id=self.value())
+        return queryset
+
+
+@admin.action(description='Re-sync selected events to the users\' calendars')
+def resync_selected_sheet_events(modeladmin, request, queryset):
+    sheet_event_ids = list(queryset.values_list('pk', flat=True))
+    enqueue_admin_action(resync_sheet_events, sheet_event_ids)
+    modeladmin.message_user(
+        request, f'Re-syncing {len(sheet_event_ids)} events in the background. '
+                 f'Occurrences of recurring series are skipped.')
+
+
+@admin.action(description='Purge selected events from the calendars and the database')
+def purge_selected_sheet_events(modeladmin, request, queryset):
+    sheet_event_ids = list(queryset.values_list('pk', flat=True))
+    skipped = queryset.filter(series__isnull=False).count()
+    enqueue_admin_action(purge_sheet_events, sheet_event_ids)
+    modeladmin.message_user(
+        request, f'Purging {len(sheet_event_ids) - skipped} events in the background, '
+                 f'{skipped} occurrences of recurring series are skipped. '
+                 f'Rows still in the sheet come back with the next poll.')
+
+
+@admin.action(description='Re-sync the events of the selected mappings')
+def resync_selected_user_caldav_events(modeladmin, request, queryset):
+    user_caldav_event_ids = list(queryset.values_list('pk', flat=True))
+    enqueue_admin_action(resync_user_caldav_events, user_caldav_event_ids)
+    modeladmin.message_user(
+        request, f'Re-syncing {len(user_caldav_event_ids)} CalDAV events in the background. '
+                 f'Occurrences of recurring series are skipped.')
+
+
+@admin.action(description='Purge selected mappings from CalDAV and the database')
+def purge_selected_user_caldav_events(modeladmin, request, queryset):
+    user_caldav_event_ids = list(queryset.values_list('pk', flat=True))
+    enqueue_admin_action(purge_user_caldav_events, user_caldav_event_ids)
+    modeladmin.message_user(
+        request, f'Purging {len(user_caldav_event_ids)} CalDAV events in the background.')
+
+
+@admin.register(UserProfile)
+class UserProfileAdmin(admin.ModelAdmin):
+    list_display = ('user',)
+    list_select_related = ('user',)
+    # Also serves the autocomplete of the other admins
+    search_fields = ('user__username',)
+    raw_id_fields = ('user',)
+
+
+@admin.register(SheetEvent)
+class SheetEventAdmin(admin.ModelAdmin):
+    list_display = ('event_id_in_sheet', 'title', 'start_time', 'end_time', 'source')
+    list_select_related = ('source',)
+    list_filter = ('start_time',)
+    search_fields = ('=event_id_in_sheet', 'title')
+    ordering = ('-start_time',)
+    raw_id_fields = ('source', 'series')
+    actions = (resync_selected_sheet_events, purge_selected_sheet_events)
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+
+@admin.register(UserEventBinding)
+class UserEventBindingAdmin(admin.ModelAdmin):
+    list_display = ('sheet_name', 'user_profile')
+    list_select_related = ('user_profile__user',)
+    list_filter = (UserListFilter,)
+    search_fields = ('sheet_name', 'user_profile__user__username')
+    autocomplete_fields = ('user_profile',)
+    show_full_result_count = False
+
+
+@admin.register(CalendarConfig)
+class CalendarConfigAdmin(admin.ModelAdmin):
+    list_display = ('user_profile', 'caldav_url', 'push_enabled', 'validation_status', 'validated_at')
+    list_select_related = ('user_profile__user',)
+    list_filter = ('push_enabled', 'validation_status')
+    search_fields = ('user_profile__user__username', 'caldav_url')
+    autocomplete_fields = ('user_profile',)
+
+
+@admin.register(UserCalDAVEvent)
+class UserCalDAVEventAdmin(admin.ModelAdmin):
+    list_display = ('caldav_uid', 'user_profile', 'sheet_event', 'last_synced')
+    list_select_related = ('user_profile__user', 'sheet_event')
+    list_filter = ('last_synced', UserListFilter)
+    search_fields = ('=caldav_uid',)
+    ordering = ('-last_synced',)
+    raw_id_fields = ('sheet_event',)
+    autocomplete_fields = ('user_profile',)
+    actions = (resync_selected_user_caldav_events, purge_selected_user_caldav_events)
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
@@ -0,0 +1,183 @@
+"""
+Minimal in-process CalDAV server for benchmarks.
+
+Implements just enough of RFC 4791 for CalDAVService: principal and
+calendar discovery via PROPFIND, event lookup by UID via REPORT, and
+PUT/GET/DELETE of event resources. Every user gets one calendar at
+/<user>/calendar/. Responses can be delayed by a fixed latency and
+throttled to a maximum request rate, to mimic a remote server.
+"""
+import re
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from xml.sax.saxutils import escape
+
+MULTISTATUS = '<?xml version="1.0" encoding="utf-8"?>\n<d:multistatus xmlns:d="DAV:" xmlns:c="urn:ietf:params:xml:ns:caldav">{}</d:multistatus>'
+RESPONSE = '<d:response><d:href>{href}</d:href><d:propstat><d:prop>{props}</d:prop><d:status>HTTP/1.1 200 OK</d:status></d:propstat></d:response>'
+
+
+class FakeCalDAVServer:
+    def __init__(self, latency=0.0, max_requests_per_second=None):
+        self.latency = latency
+        self.max_requests_per_second = max_requests_per_second
+        self.resources = {}  # path -> iCalendar text
+        self.requests = Counter()  # method -> count
+        self._lock = threading.Lock()
+        self._next_slot = 0.0
+        self._httpd = ThreadingHTTPServer(('127.0.0.1', 0), self._handler_class())
+        self._httpd.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._httpd.server_address
+        return f'http://{host}:{port}/'
+
+    def user_url(self, user):
+        return f'{self.url}{user}/'
+
+    def calendar_url(self, user):
+        return f'{self.url}{user}/calendar/'
+
+    @property
+    def total_requests(self):
+        return sum(self.requests.values())
+
+    def reset_counters(self):
+        with self._lock:
+            self.requests.clear()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def _wait_for_slot(self, method):
+        with self._lock:
+            self.requests[method] += 1
+            delay = self.latency
+            if self.max_requests_per_second:
+                # Queue requests exceeding the rate instead of rejecting them
+                now = time.monotonic()
+                slot = max(now, self._next_slot)
+                self._next_slot = slot + 1.0 / self.max_requests_per_second
+                delay += slot - now
+        if delay:
+            time.sleep(delay)
+
+    def _handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, format, *args):
+                pass
+
+            def _body(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                return self.rfile.read(length).decode('utf-8') if length else ''
+
+            def _reply(self, status, body='', content_type='application/xml; charset=utf-8', headers=None):
+                data = body.encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(data)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _path_parts(self):
+                return [part for part in self.path.split('?')[0].split('/') if part]
+
+            def do_OPTIONS(self):
+                server._wait_for_slot('OPTIONS')
+                self._reply(200, headers={'DAV': '1, 2, calendar-access',
+                                          'Allow': 'OPTIONS, GET, PUT, DELETE, PROPFIND, REPORT'})
+
+            def do_PROPFIND(self):
+                server._wait_for_slot('PROPFIND')
+                self._body()
+                depth = self.headers.get('Depth', '0')
+                parts = self._path_parts()
+                user = parts[0] if parts else 'user'
+                user_path = f'/{user}/'
+                calendar_path = f'/{user}/calendar/'
+                principal_props = (
+                    f'<d:current-user-principal><d:href>{user_path}</d:href></d:current-user-principal>'
+                    f'<c:calendar-home-set><d:href>{user_path}</d:href></c:calendar-home-set>'
+                    '<d:resourcetype><d:collection/></d:resourcetype>'
+                    f'<d:displayname>{escape(user)}</d:displayname>')
+                calendar_props = (
+                    '<d:resourcetype><d:collection/><c:calendar/></d:resourcetype>'
+                    '<d:displayname>Calendar</d:displayname>'
+                    '<c:supported-calendar-component-set><c:comp name="VEVENT"/></c:supported-calendar-component-set>')
+                if len(parts) >= 2:
+                    responses = [RESPONSE.format(href=calendar_path, props=calendar_props)]
+                else:
+                    responses = [RESPONSE.format(href=user_path, props=principal_props)]
+                    if depth == '1':
+                        responses.append(RESPONSE.format(href=calendar_path, props=calendar_props))
+                self._reply(207, MULTISTATUS.format(''.join(responses)))
+
+            def do_REPORT(self):
+                server._wait_for_slot('REPORT')
+                body = self._body()
+                prefix = self.path.split('?')[0]
+                uid_match = re.search(r'<[^>]*text-match[^>]*>([^<]+)</', body)
+                hrefs = re.findall(r'<[^>]*href>([^<]+)</', body)
+                responses = []
+                for path, data in list(server.resources.items()):
+                    if not path.startswith(prefix):
+                        continue
+                    if uid_match and f'UID:{uid_match.group(1).strip()}' not in data:
+                        continue
+                    if hrefs and path not in hrefs:
+                        continue
+                    props = (f'<d:getetag>"{hash(data)}"</d:getetag>'
+                             f'<c:calendar-data>{escape(data)}</c:calendar-data>')
+                    responses.append(RESPONSE.format(href=path, props=props))
+                self._reply(207, MULTISTATUS.format(''.join(responses)))
+
+            def do_GET(self):
+                server._wait_for_slot('GET')
+                data = server.resources.get(self.path)
+                if data is None:
+                    self._reply(404)
+                else:
+                    self._reply(200, data, content_type='text/calendar; charset=utf-8',
+                                headers={'ETag': f'"{hash(data)}"'})
+
+            def do_PUT(self):
+                server._wait_for_slot('PUT')
+                body = self._body()
+                # CalDAV's no-uid-conflict precondition: a UID lives in one resource
+                uid_match = re.search(r'^UID:(.+?)\r?$', body, re.MULTILINE)
+                if uid_match and any(f'UID:{uid_match.group(1)}' in data
+                                     for path, data in list(server.resources.items())
+                                     if path != self.path and path.startswith(self.path.rsplit('/', 1)[0])):
+                    self._reply(409)
+                    return
+                created = self.path not in server.resources
+                server.resources[self.path] = body
+                self._reply(201 if created else 204, headers={'ETag': f'"{hash(body)}"'})
+
+            def do_DELETE(self):
+                server._wait_for_slot('DELETE')
+                existed = server.resources.pop(self.path, None) is not None
+                self._reply(204 if existed else 404)
+
+        return Handler
@@ -0,0 +1,68 @@
+"""Synthetic Google Sheets data in the layout poll_sheet expects."""
+import datetime
+import random
+
+from ..metrics import metrics, PHASE_SHEETS_FETCH
+
+HEADERS = ['ID', 'Title', 'Description', 'Start', 'End',
+           'Person 1', 'Person 2', 'Person 3', 'Person 4']
+DATE_FORMAT = '%d/%m/%Y %H:%M:%S'
+TITLES = ['Early shift', 'Late shift', 'Night shift', 'Briefing', 'Training']
+
+
+def assignee_names(count):
+    return [f'Person {i}' for i in range(count)]
+
+
+def _row(event_id, rng, assignees, start):
+    duration = datetime.timedelta(hours=rng.choice([2, 4, 8]))
+    people = rng.sample(assignees, k=min(len(assignees), rng.randint(1, 4)))
+    people += [''] * (4 - len(people))
+    return [event_id, rng.choice(TITLES), f'Synthetic event {event_id}',
+            start.strftime(DATE_FORMAT), (start + duration).strftime(DATE_FORMAT)] + people
+
+
+def generate_sheet(rows, assignees=10, seed=0, first_day=datetime.datetime(2026, 1, 5, 6, 0)):
+    """Header plus `rows` events spread over consecutive days, 1-4 assignees each."""
+    rng = random.Random(seed)
+    names = assignee_names(assignees)
+    data = [list(HEADERS)]
+    for i in range(rows):
+        start = first_day + datetime.timedelta(days=i // 4, hours=(i % 4) * 4)
+        data.append(_row(f'evt-{i}', rng, names, start))
+    return data
+
+
+def churn_sheet(sheet, ratio, assignees=10, seed=1):
+    """
+    Copy of the sheet with `ratio` of its rows changed: half of them get a new
+    title and time, a quarter are removed and a quarter are replaced by new events.
+    """
+    rng = random.Random(seed)
+    names = assignee_names(assignees)
+    header, rows = sheet[0], [list(row) for row in sheet[1:]]
+    changed = rng.sample(range(len(rows)), k=int(len(rows) * ratio))
+    removed = set()
+    for n, index in enumerate(changed):
+        row = rows[index]
+        start = datetime.datetime.strptime(row[3], DATE_FORMAT) + datetime.timedelta(hours=1)
+        if n % 4 in (0, 1):
+            rows[index] = _row(row[0], rng, names, start)
+        elif n % 4 == 2:
+            removed.add(index)
+        else:
+            rows[index] = _row(f'{row[0]}-new', rng, names, start)
+    return [header] + [row for i, row in enumerate(rows) if i not in removed]
+
+
+class SyntheticSheetsService:
+    """Stand-in for GoogleSheetsService serving in-memory sheet data."""
+
+    def __init__(self, sheet_data):
+        self.sheet_data = sheet_data
+        self.calls = 0
+
+    def get_sheet_data(self, spreadsheet_id, range_name):
+        self.calls += 1
+        with metrics.span(PHASE_SHEETS_FETCH):
+            return [list(row) for row in self.sheet_data]
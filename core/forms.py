@@ -5,7 +5,7 @@ from .models import CalendarConfig, UserEventBinding
 class CalDAVConfigForm(forms.ModelForm):
     class Meta:
         model = CalendarConfig
-        fields = ['caldav_url', 'caldav_username', 'caldav_password']
+        fields = ['caldav_url', 'caldav_username', 'caldav_password', 'push_enabled']
         widgets = {
             'caldav_password': forms.PasswordInput(),
         }
@@ -0,0 +1,187 @@
+import io
+import json
+import platform
+import time
+import tracemalloc
+
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.utils import timezone
+from core.benchmarks.fake_caldav import FakeCalDAVServer
+from core.benchmarks.synthetic import SyntheticSheetsService, assignee_names, churn_sheet, generate_sheet
+from core.models import UserProfile, UserEventBinding, CalendarConfig
+
+# Metrics compared against a baseline, and whether higher values are better
+COMPARED_METRICS = {
+    'rows_per_second': True,
+    'http_requests_per_event': False,
+    'db_queries_per_row': False,
+    'peak_memory_bytes': False,
+}
+
+# Options describing the workload, results are only comparable when they match
+BENCHMARK_PARAMETERS = ('rows', 'assignees', 'users', 'churn', 'latency_ms', 'max_rps')
+
+
+class Command(BaseCommand):
+    help = ('Benchmarks poll_sheet end to end with a synthetic sheet and a local fake CalDAV server. '
+            'Runs against a throwaway test database, never the configured one.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=200,
+                            help='Number of events in the synthetic sheet.')
+        parser.add_argument('--assignees', type=int, default=10,
+                            help='Number of distinct person names in the sheet.')
+        parser.add_argument('--users', type=int, default=5,
+                            help='Number of users bound to a person name with a CalDAV calendar.')
+        parser.add_argument('--churn', type=float, default=0.3,
+                            help='Ratio of rows changed for the heavy-churn scenario.')
+        parser.add_argument('--latency_ms', type=float, default=0,
+                            help='Delay of every fake CalDAV response in milliseconds.')
+        parser.add_argument('--max_rps', type=float, default=None,
+                            help='Requests per second the fake CalDAV server accepts before queueing.')
+        parser.add_argument('--output', type=str,
+                            help='Write the results as JSON to this file, e.g. to store a new baseline.')
+        parser.add_argument('--baseline', type=str,
+                            help='Compare against a stored JSON result and fail on regressions.')
+        parser.add_argument('--tolerance', type=float, default=0.25,
+                            help='Allowed relative regression when comparing against --baseline.')
+
+    def handle(self, *args, **options):
+        if options['users'] > options['assignees']:
+            raise CommandError('--users cannot exceed --assignees.')
+        parameters = {key: options[key] for key in BENCHMARK_PARAMETERS}
+        baseline = None
+        if options['baseline']:
+            baseline = self._load_baseline(options['baseline'], parameters)
+
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            with FakeCalDAVServer(latency=options['latency_ms'] / 1000,
+                                  max_requests_per_second=options['max_rps']) as server:
+                results = self._run_scenarios(server, options)
+                # tracemalloc slows the sync down several times, so memory is
+                # measured in a second pass from a clean state
+                call_command('flush', interactive=False, verbosity=0)
+                server.resources.clear()
+                traced = self._run_scenarios(server, options, trace_memory=True)
+                for name, result in results.items():
+                    result['peak_memory_bytes'] = traced[name]['peak_memory_bytes']
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        report = {
+            'generated_at': timezone.now().isoformat(),
+            'python': platform.python_version(),
+            'parameters': parameters,
+            'scenarios': results,
+        }
+        for name, result in results.items():
+            self.stdout.write(
+                f"{name}: {result['rows_per_second']:.1f} rows/s, "
+                f"{result['http_requests_per_event']:.2f} HTTP requests/event, "
+                f"{result['db_queries_per_row']:.2f} DB queries/row, "
+                f"peak {result['peak_memory_bytes'] / 1024 / 1024:.1f} MiB")
+
+        if options['output']:
+            with open(options['output'], 'w') as output_file:
+                json.dump(report, output_file, indent=2)
+            self.stdout.write(self.style.SUCCESS(f"Results written to {options['output']}"))
+
+        if baseline is not None:
+            self._compare(report, baseline, options['baseline'], options['tolerance'])
+
+    def _run_scenarios(self, server, options, trace_memory=False):
+        names = assignee_names(options['assignees'])
+        for i in range(options['users']):
+            user = User.objects.create_user(f'bench{i}')
+            user_profile = UserProfile.objects.create(user=user)
+            UserEventBinding.objects.create(user_profile=user_profile, sheet_name=names[i])
+            CalendarConfig.objects.create(
+                user_profile=user_profile,
+                caldav_url=server.user_url(user.username),
+                caldav_username=user.username,
+                caldav_password='bench',
+                validation_status=CalendarConfig.VALIDATION_OK,
+                calendar_url=server.calendar_url(user.username),
+            )
+
+        sheet = generate_sheet(options['rows'], options['assignees'])
+        churned = churn_sheet(sheet, options['churn'], options['assignees'])
+        return {
+            'first_sync': self._measure(sheet, server, trace_memory),
+            'steady_state': self._measure(sheet, server, trace_memory),
+            'heavy_churn': self._measure(churned, server, trace_memory),
+        }
+
+    def _measure(self, sheet, server, trace_memory=False):
+        queries = []
+
+        def count_queries(execute, sql, params, many, context):
+            queries.append(sql)
+            return execute(sql, params, many, context)
+
+        rows = len(sheet) - 1
+        server.reset_counters()
+        if trace_memory:
+            tracemalloc.start()
+        start = time.perf_counter()
+        with connection.execute_wrapper(count_queries):
+            call_command('poll_sheet', spreadsheet_id='benchmark', metrics_file='', run_log='',
+                         sheets_service=SyntheticSheetsService(sheet), stdout=io.StringIO())
+        seconds = time.perf_counter() - start
+        peak_memory = None
+        if trace_memory:
+            # Includes the fake server threads, they run in this process
+            peak_memory = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+        return {
+            'rows': rows,
+            'seconds': seconds,
+            'rows_per_second': rows / seconds if seconds else 0.0,
+            'http_requests': server.total_requests,
+            'http_requests_by_method': dict(server.requests),
+            'http_requests_per_event': server.total_requests / rows if rows else 0.0,
+            'db_queries': len(queries),
+            'db_queries_per_row': len(queries) / rows if rows else 0.0,
+            'peak_memory_bytes': peak_memory,
+        }
+
+    def _load_baseline(self, baseline_path, parameters):
+        """Reads the baseline, which must have been measured with the same parameters."""
+        with open(baseline_path) as baseline_file:
+            baseline = json.load(baseline_file)
+        differences = []
+        for key, value in parameters.items():
+            expected = baseline['parameters'].get(key)
+            if expected != value:
+                differences.append(f'--{key} {expected}' if expected is not None else f'without --{key}')
+        if differences:
+            raise CommandError(
+                f'{baseline_path} was measured with different parameters, '
+                f'run with {" ".join(differences)} to compare.')
+        return baseline
+
+    def _compare(self, report, baseline, baseline_path, tolerance):
+        regressions = []
+        for name, result in report['scenarios'].items():
+            expected = baseline['scenarios'].get(name)
+            if not expected:
+                continue
+            for metric, higher_is_better in COMPARED_METRICS.items():
+                old, new = expected[metric], result[metric]
+                if not old:
+                    continue
+                change = (new - old) / old
+                if (-change if higher_is_better else change) > tolerance:
+                    regressions.append(f'{name} {metric}: {old:.2f} -> {new:.2f} ({change:+.0%})')
+
+        if regressions:
+            for regression in regressions:
+                self.stdout.write(self.style.ERROR(regression))
+            raise CommandError(f'{len(regressions)} metric(s) regressed against {baseline_path}.')
+        self.stdout.write(self.style.SUCCESS(f'No regressions against {baseline_path}.'))
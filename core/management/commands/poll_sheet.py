@@ -1,38 +1,158 @@
-from django.core.management.base import BaseCommand
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import F, Q
 from django.utils import timezone
-from core.services import GoogleSheetsService, CalDAVService
+from core.metrics import metrics, PHASE_DB_UPSERT, PHASE_PARSE
+from core.profiling import profiler, profiling_enabled
+from core.services import GoogleSheetsService, CalDAVService, new_series_uid, new_sheet_event_uid
 from core.models import SheetEvent, UserProfile, UserEventBinding, CalendarConfig, UserCalDAVEvent
+from core.models import EventSeries, UserCalDAVSeries, SheetSource
+from core.recurrence import collapse_recurring_events
+from core.runlog import RunLog
+from collections import Counter
 import datetime
+import os
+import socket
+import time
+import uuid
 import pytz
 
 
 class Command(BaseCommand):
     help = 'Polls Google Sheet for events, updates the database, and syncs to CalDAV.'
+    # call_command() only: a GoogleSheetsService replacement, e.g. for benchmarks
+    stealth_options = ('sheets_service',)
+    # SheetSource leased by the running poll, see handle()
+    source = None
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Replaced per run in handle(), these serve direct calls of the sync methods
+        self.verbosity = 1
+        self.run_log = RunLog(None, None)
+        self.summary = Counter()
 
     def add_arguments(self, parser):
         parser.add_argument('--spreadsheet_id', type=str, required=True,
                             help='The ID of the Google Spreadsheet.')
         parser.add_argument('--range_name', type=str, default='Sheet1!A:I',
                             help='The A1 notation of the range to retrieve (e.g., Sheet1!A:I).')
+        parser.add_argument('--metrics_file', type=str,
+                            default=getattr(settings, 'SYNC_METRICS_FILE', None),
+                            help='Where to write the JSON run report (timings and counters per phase).')
+        parser.add_argument('--collapse_recurring', action='store_true',
+                            default=getattr(settings, 'SYNC_COLLAPSE_RECURRING', False),
+                            help='Write regularly repeating events as one recurring CalDAV event per series.')
+        parser.add_argument('--incremental', action='store_true',
+                            help='Only push created or changed events to CalDAV, e.g. after a change notification.')
+        parser.add_argument('--run_log', type=str,
+                            default=getattr(settings, 'SYNC_RUN_LOG_FILE', None),
+                            help='JSON-lines file receiving one line per row and CalDAV operation '
+                                 '(empty to disable). The console only shows a summary and errors '
+                                 'unless --verbosity 2 is given.')
+        parser.add_argument('--profile', action='store_true',
+                            help='Report SQL queries, HTTP calls and time per row and user, '
+                                 'also enabled by SYNC_PROFILING or CAL_SYNC_PROFILE=1.')
 
     def handle(self, *args, **options):
-        spreadsheet_id = options['spreadsheet_id']
-        range_name = options['range_name']
+        source, created = SheetSource.objects.get_or_create(
+            spreadsheet_id=options['spreadsheet_id'], defaults={'range_name': options['range_name']})
+        self.verbosity = options['verbosity']
+        self.run_id = uuid.uuid4().hex[:12]
+        # Cron may start a run while the previous one is still busy
+        self.lease_owner = f'{socket.gethostname()}:{os.getpid()}:{self.run_id}'
+        self.lease_duration = datetime.timedelta(
+            seconds=getattr(settings, 'SYNC_LEASE_SECONDS', 15 * 60))
+        if not source.acquire_lease(self.lease_owner, self.lease_duration):
+            source.refresh_from_db(fields=['lease_owner', 'lease_expires_at'])
+            self.stdout.write(self.style.WARNING(
+                f"Sheet {source.spreadsheet_id} is being synced by {source.lease_owner} "
+                f"(lease until {source.lease_expires_at}). Skipping this run."))
+            return
+        self.source = source
+        self._lease_renewed = time.monotonic()
+
+        metrics.reset()
+        profile = options['profile'] or profiling_enabled()
+        if profile:
+            profiler.start()
+        self.collapse_recurring = options['collapse_recurring']
+        self.incremental = options['incremental']
+        self.run_log = RunLog(options['run_log'], self.run_id, sheet=source.spreadsheet_id)
+        self.summary = Counter()
+        start = time.perf_counter()
+        try:
+            self._poll(source, options['range_name'], options.get('sheets_service'))
+        finally:
+            source.release_lease(self.lease_owner)
+            self._write_summary(source, time.perf_counter() - start)
+            self.run_log.close()
+            if options['metrics_file']:
+                metrics.write_report(options['metrics_file'])
+            if profile:
+                profiler.stop()
+                self.stdout.write(self.style.HTTP_INFO('Profile (top offenders):'))
+                for line in profiler.format_report():
+                    self.stdout.write(line)
+
+    def _detail(self, message, style_func):
+        """Per row and per user output, shown with --verbosity 2 or more."""
+        if self.verbosity >= 2:
+            self.stdout.write(style_func(message))
+
+    def _error(self, message):
+        self.summary['errors'] += 1
+        self.stdout.write(self.style.ERROR(message))
+
+    def _row_done(self, row, outcome, event_id=None, duration=None, error=None):
+        metrics.inc('cal_sync_rows_total', outcome=outcome)
+        self.summary[f'rows_{outcome}'] += 1
+        self.run_log.record('row', outcome, row=row, event_id=event_id, duration=duration, error=error)
+
+    def _write_summary(self, source, duration):
+        summary = self.summary
+        rows = sum(summary[f'rows_{outcome}'] for outcome in
+                   ('created', 'updated', 'unchanged', 'skipped', 'error'))
+        self.run_log.record('run', 'error' if summary['errors'] else 'ok', duration=duration)
+        if self.verbosity >= 1:
+            style = self.style.ERROR if summary['errors'] else self.style.SUCCESS
+            self.stdout.write(style(
+                f"Synced sheet {source.spreadsheet_id}: {rows} rows ({summary['rows_created']} created, "
+                f"{summary['rows_updated']} updated, {summary['rows_unchanged']} unchanged, "
+                f"{summary['rows_skipped']} skipped, {summary['rows_error']} invalid), "
+                f"{summary['events_deleted']} removed; CalDAV: {summary['caldav_written']} written, "
+                f"{summary['caldav_deleted']} deleted, {summary['caldav_failed']} failed; "
+                f"{summary['errors']} errors in {duration:.1f}s."))
+
+    def _renew_lease(self):
+        """Extends the run lease once a third of it has passed, aborts if another run took it over."""
+        if self.source is None or time.monotonic() - self._lease_renewed < self.lease_duration.total_seconds() / 3:
+            return
+        if not self.source.acquire_lease(self.lease_owner, self.lease_duration):
+            raise CommandError(
+                f"Lost the lease on sheet {self.source.spreadsheet_id} to another run. Aborting.")
+        self._lease_renewed = time.monotonic()
+
+    def _poll(self, source, range_name, gs_service=None):
         # Get Django's default timezone from settings.py (USE_TZ=True recommended)
         local_timezone = pytz.timezone(timezone.get_current_timezone().key)
+        started_at = timezone.now()
+        spreadsheet_id = source.spreadsheet_id
 
-        self.stdout.write(self.style.SUCCESS(
-            f'Polling Google Sheet: {spreadsheet_id} range: {range_name}'))
+        self._detail(
+            f'Polling Google Sheet: {spreadsheet_id} range: {range_name}', self.style.SUCCESS)
 
         # Initialize Google Sheets Service (this will perform the initial OAuth flow if token.pickle doesn't exist)
         try:
-            gs_service = GoogleSheetsService()
+            if gs_service is None:
+                gs_service = GoogleSheetsService()
             sheet_data = gs_service.get_sheet_data(spreadsheet_id, range_name)
         except Exception as e:
-            self.stdout.write(self.style.ERROR(
-                f'Failed to connect to Google Sheets API: {e}'))
-            self.stdout.write(self.style.ERROR(
-                'Please ensure `credentials.json` is in the project root and you have authenticated via the browser during the first run.'))
+            self._error(
+                f'Failed to connect to Google Sheets API: {e}')
+            self._error(
+                'Please ensure `credentials.json` is in the project root and you have authenticated via the browser during the first run.')
             return
 
         if not sheet_data:
@@ -63,204 +183,525 @@ class Command(BaseCommand):
                             'end_time', 'event_id_in_sheet']
         for col in required_columns:
             if col not in column_map or column_map[col] >= len(headers):
-                self.stdout.write(self.style.ERROR(
-                    f"Missing or incorrect column mapping for '{col}'. Check `column_map` and `range_name`."))
+                self._error(
+                    f"Missing or incorrect column mapping for '{col}'. Check `column_map` and `range_name`.")
                 return
 
         # To track event IDs present in the current sheet fetch
         processed_sheet_event_ids = set()
+        # Names of people whose assigned events were created, changed or removed
+        changed_person_names = set()
+        # Created or updated events, the only ones pushed in incremental mode
+        changed_sheet_event_ids = set()
+        # Pushed to CalDAV in one batch per user after the loop
+        sheet_events_to_push = []
 
         for i, row in enumerate(event_rows):
             # Ensure row has enough columns for all mapped data
             if len(row) < max(column_map.values()) + 1:
-                self.stdout.write(self.style.WARNING(
-                    f'Skipping row {i+2} (0-indexed row {i+1}) due to insufficient columns: {row}'))
+                self._row_done(i + 2, 'skipped')
+                self._detail(
+                    f'Skipping row {i+2} (0-indexed row {i+1}) due to insufficient columns: {row}', self.style.WARNING)
                 continue
 
-            try:
-                start_time_str = row[column_map['start_time']]
-                end_time_str = row[column_map['end_time']]
-
-                start_time = datetime.datetime.strptime(
-                    start_time_str, '%d/%m/%Y %H:%M:%S')
-                end_time = datetime.datetime.strptime(
-                    end_time_str, '%d/%m/%Y %H:%M:%S')
-
-                # Make timezone aware using Django's configured timezone
-                start_time = local_timezone.localize(start_time)
-                end_time = local_timezone.localize(end_time)
-
-                event_id_in_sheet = row[column_map['event_id_in_sheet']]
-                if not event_id_in_sheet:
-                    self.stdout.write(self.style.WARNING(
-                        f'Skipping row {i+2}: No unique event ID found.'))
+            self._renew_lease()
+            row_start = time.perf_counter()
+            with profiler.unit('row', f'row {i+2}'):
+                try:
+                    with metrics.span(PHASE_PARSE):
+                        event_id_in_sheet, defaults = self._parse_row(
+                            row, column_map, local_timezone)
+                        defaults['source_id'] = source.pk
+                    if not event_id_in_sheet:
+                        self._row_done(i + 2, 'skipped')
+                        self._detail(
+                            f'Skipping row {i+2}: No unique event ID found.', self.style.WARNING)
+                        continue
+
+                    processed_sheet_event_ids.add(event_id_in_sheet)
+
+                    with metrics.span(PHASE_DB_UPSERT):
+                        sheet_event, outcome = self._upsert_sheet_event(
+                            event_id_in_sheet, defaults, changed_person_names)
+                    self._row_done(i + 2, outcome, event_id_in_sheet,
+                                   duration=time.perf_counter() - row_start)
+                    if outcome != 'unchanged':
+                        changed_sheet_event_ids.add(sheet_event.pk)
+                    if outcome == 'created':
+                        self._detail(
+                            f'Created new SheetEvent: {sheet_event.title} (ID: {sheet_event.event_id_in_sheet})', self.style.SUCCESS)
+                    elif outcome == 'updated':
+                        self._detail(
+                            f'Updated SheetEvent: {sheet_event.title} (ID: {sheet_event.event_id_in_sheet})', self.style.SUCCESS)
+
+                    # --- Queue CalDAV Sync for this event ---
+                    # (deferred until the series are known when collapsing)
+                    if not self.collapse_recurring and \
+                            (not self.incremental or outcome != 'unchanged'):
+                        sheet_events_to_push.append(sheet_event)
+
+                except (ValueError, IndexError, KeyError) as e:
+                    self._row_done(i + 2, 'error', error=e)
+                    self._error(
+                        f'Error processing row {i+2}: {row} - {e}')
                     continue
 
-                processed_sheet_event_ids.add(event_id_in_sheet)
-
-                # Get person names, handling cases where they might be empty or missing
-                person1_name = row[column_map['person1']
-                                   ] if column_map['person1'] < len(row) else None
-                person2_name = row[column_map['person2']
-                                   ] if column_map['person2'] < len(row) else None
-                person3_name = row[column_map['person3']
-                                   ] if column_map['person3'] < len(row) else None
-                person4_name = row[column_map['person4']
-                                   ] if column_map['person4'] < len(row) else None
-
-                sheet_event, created = SheetEvent.objects.update_or_create(
-                    event_id_in_sheet=event_id_in_sheet,
-                    defaults={
-                        'title': row[column_map['title']],
-                        'description': row[column_map['description']] if column_map['description'] < len(row) else '',
-                        'start_time': start_time,
-                        'end_time': end_time,
-                        'person1_name': person1_name,
-                        'person2_name': person2_name,
-                        'person3_name': person3_name,
-                        'person4_name': person4_name,
-                    }
-                )
-                if created:
-                    self.stdout.write(self.style.SUCCESS(
-                        f'Created new SheetEvent: {sheet_event.title} (ID: {sheet_event.event_id_in_sheet})'))
-                else:
-                    self.stdout.write(self.style.SUCCESS(
-                        f'Updated SheetEvent: {sheet_event.title} (ID: {sheet_event.event_id_in_sheet})'))
-
-                # --- Trigger CalDAV Sync for this event ---
-                self._sync_sheet_event_to_users_calendars(
-                    sheet_event, self.stdout, self.style)
-
-            except (ValueError, IndexError, KeyError) as e:
-                self.stdout.write(self.style.ERROR(
-                    f'Error processing row {i+2}: {row} - {e}'))
-                continue
+        if not self.collapse_recurring:
+            # Occurrences of series from an earlier collapsing run are written
+            # individually again before their series is dissolved below, even
+            # in incremental mode where unchanged events aren't queued
+            queued_ids = {sheet_event.pk for sheet_event in sheet_events_to_push}
+            sheet_events_to_push.extend(
+                sheet_event for sheet_event in SheetEvent.objects.filter(
+                    source=source, series__isnull=False,
+                    event_id_in_sheet__in=list(processed_sheet_event_ids))
+                if sheet_event.pk not in queued_ids)
 
-        # --- Handle deletions from Sheet ---
-        # Find SheetEvents in our DB that are no longer present in the fetched sheet data
-        events_to_delete_from_db = SheetEvent.objects.exclude(
-            event_id_in_sheet__in=list(processed_sheet_event_ids))
-        for sheet_event in events_to_delete_from_db:
-            self.stdout.write(self.style.WARNING(
-                f"SheetEvent '{sheet_event.title}' (ID: {sheet_event.event_id_in_sheet}) no longer in sheet. Deleting from DB and CalDAV."))
-            self._delete_sheet_event_from_users_calendars(
-                sheet_event, self.stdout, self.style)
-            sheet_event.delete()  # Delete from your DB as well
+        self._sync_sheet_events_to_users_calendars(
+            sheet_events_to_push)
 
-        self.stdout.write(self.style.SUCCESS(
-            'Finished polling Google Sheet and syncing events.'))
+        # --- Handle deletions from Sheet ---
+        # Find SheetEvents of this spreadsheet that are no longer present in the fetched sheet data
+        # (events stored before sources were tracked belong to whichever spreadsheet is polled)
+        events_to_delete_from_db = list(SheetEvent.objects.filter(
+            Q(source=source) | Q(source__isnull=True)).exclude(
+            event_id_in_sheet__in=list(processed_sheet_event_ids)))
+        if events_to_delete_from_db:
+            self._renew_lease()
+            for sheet_event in events_to_delete_from_db:
+                self._detail(
+                    f"SheetEvent '{sheet_event.title}' (ID: {sheet_event.event_id_in_sheet}) no longer in sheet. Deleting from DB and CalDAV.", self.style.WARNING)
+                changed_person_names.update(sheet_event.person_names())
+            self._delete_sheet_events_from_users_calendars(
+                events_to_delete_from_db)
+            # Delete from your DB as well
+            SheetEvent.objects.filter(pk__in=[sheet_event.pk for sheet_event in events_to_delete_from_db]).delete()
+            metrics.inc('cal_sync_events_deleted_total', len(events_to_delete_from_db))
+            self.summary['events_deleted'] += len(events_to_delete_from_db)
+
+        # --- Collapse repeating events into recurring CalDAV events ---
+        if self.collapse_recurring:
+            self._sync_collapsed(source, changed_sheet_event_ids)
+        elif SheetEvent.objects.filter(source=source, series__isnull=False).update(series=None):
+            # Series of an earlier collapsing run, their events were pushed individually above
+            for series in EventSeries.objects.filter(
+                    Q(source=source) | Q(source__isnull=True), occurrences__isnull=True):
+                self._delete_series_from_users_calendars(series)
+                series.delete()
+
+        # --- Invalidate feeds and dashboards of affected users only ---
+        if changed_person_names:
+            changed_person_names.update(name.strip()
+                                        for name in list(changed_person_names))
+            affected_profile_ids = UserEventBinding.objects.filter(
+                sheet_name__in=changed_person_names).values_list('user_profile_id', flat=True)
+            UserProfile.objects.filter(
+                pk__in=list(affected_profile_ids)).bump_events_version()
+
+        SheetSource.objects.filter(pk=source.pk).update(
+            range_name=range_name, last_synced_at=timezone.now())
+        # Notifications received during the run need another sync
+        SheetSource.objects.filter(
+            pk=source.pk, sync_requested_at__lte=started_at).update(sync_requested_at=None)
+
+        self._detail(
+            'Finished polling Google Sheet and syncing events.', self.style.SUCCESS)
+
+    def _parse_row(self, row, column_map, local_timezone):
+        """
+        Decodes a sheet row into the event ID and the SheetEvent field values.
+        Raises ValueError/IndexError/KeyError on malformed rows.
+        """
+        start_time_str = row[column_map['start_time']]
+        end_time_str = row[column_map['end_time']]
+
+        start_time = datetime.datetime.strptime(
+            start_time_str, '%d/%m/%Y %H:%M:%S')
+        end_time = datetime.datetime.strptime(
+            end_time_str, '%d/%m/%Y %H:%M:%S')
+
+        # Make timezone aware using Django's configured timezone
+        start_time = local_timezone.localize(start_time)
+        end_time = local_timezone.localize(end_time)
+
+        event_id_in_sheet = row[column_map['event_id_in_sheet']]
+
+        # Get person names, handling cases where they might be empty or missing
+        person1_name = row[column_map['person1']
+                           ] if column_map['person1'] < len(row) else None
+        person2_name = row[column_map['person2']
+                           ] if column_map['person2'] < len(row) else None
+        person3_name = row[column_map['person3']
+                           ] if column_map['person3'] < len(row) else None
+        person4_name = row[column_map['person4']
+                           ] if column_map['person4'] < len(row) else None
+
+        defaults = {
+            'title': row[column_map['title']],
+            'description': row[column_map['description']] if column_map['description'] < len(row) else '',
+            'start_time': start_time,
+            'end_time': end_time,
+            'person1_name': person1_name,
+            'person2_name': person2_name,
+            'person3_name': person3_name,
+            'person4_name': person4_name,
+        }
+        return event_id_in_sheet, defaults
 
-    def _sync_sheet_event_to_users_calendars(self, sheet_event, stdout, style):
+    def _upsert_sheet_event(self, event_id_in_sheet, defaults, changed_person_names):
+        """
+        Creates or updates the SheetEvent, writing only when a field changed.
+        Names of people gaining or losing the event are added to changed_person_names.
+        Returns the SheetEvent and 'created', 'updated' or 'unchanged'.
+        """
+        # Events stored before sources were tracked are adopted by the source
+        sheet_event = SheetEvent.objects.filter(
+            Q(source_id=defaults['source_id']) | Q(source__isnull=True),
+            event_id_in_sheet=event_id_in_sheet).order_by(F('source').asc(nulls_last=True)).first()
+        if sheet_event is None:
+            sheet_event = SheetEvent.objects.create(
+                event_id_in_sheet=event_id_in_sheet, **defaults)
+            changed_person_names.update(sheet_event.person_names())
+            return sheet_event, 'created'
+        if any(getattr(sheet_event, field) != value for field, value in defaults.items()):
+            # Users losing the event are affected as well as those gaining it
+            changed_person_names.update(sheet_event.person_names())
+            for field, value in defaults.items():
+                setattr(sheet_event, field, value)
+            sheet_event.save()
+            changed_person_names.update(sheet_event.person_names())
+            return sheet_event, 'updated'
+        return sheet_event, 'unchanged'
+
+    def _sync_collapsed(self, source, changed_sheet_event_ids):
+        """
+        Detects series among the SheetEvents of the source, then pushes the
+        events outside any series individually and every series as one
+        recurring event.
         """
-        Synchronizes a single SheetEvent to the calendars of all relevant users.
+        sheet_events = list(SheetEvent.objects.filter(source=source).order_by('start_time'))
+        previous_series_ids = {sheet_event.pk: sheet_event.series_id for sheet_event in sheet_events}
+        series_list, stale_series = collapse_recurring_events(sheet_events, source)
+        for series in stale_series:
+            self._detail(
+                f"Series '{series.title}' is no longer repeating. Deleting it from CalDAV.", self.style.WARNING)
+            self._delete_series_from_users_calendars(series)
+            series.delete()
+
+        occurrences = {}
+        individual_events = []
+        for sheet_event in sheet_events:
+            if sheet_event.series_id is None:
+                # Events leaving a series must be pushed individually again
+                if not self.incremental or sheet_event.pk in changed_sheet_event_ids or \
+                        previous_series_ids[sheet_event.pk] is not None:
+                    individual_events.append(sheet_event)
+            else:
+                occurrences.setdefault(sheet_event.series_id, []).append(sheet_event)
+        self._sync_sheet_events_to_users_calendars(individual_events)
+        # Pushed individually before they became part of a series
+        self._delete_sheet_events_from_users_calendars(
+            [sheet_event for sheet_event in sheet_events if sheet_event.series_id is not None])
+
+        for series in series_list:
+            self._renew_lease()
+            self._detail(
+                f"Series '{series.title}': {len(occurrences[series.pk])} events every {series.interval_days} days", self.style.SUCCESS)
+            self._sync_series_to_users_calendars(
+                series, occurrences[series.pk])
+
+    def _sync_series_to_users_calendars(self, series, occurrences):
         """
-        # Collect all person names from the sheet event that are not empty/None
-        sheet_person_names = [
-            sheet_event.person1_name,
-            sheet_event.person2_name,
-            sheet_event.person3_name,
-            sheet_event.person4_name,
-        ]
-        # Filter out None and empty strings
-        sheet_person_names = [
-            name.strip() for name in sheet_person_names if name and name.strip()]
-
-        # If no names are assigned to the event, there's no one to sync it to.
+        Synchronizes an EventSeries as one recurring event to the calendars of all relevant users.
+        """
+        sheet_person_names = [name.strip() for name in series.person_names() if name.strip()]
         if not sheet_person_names:
             return
 
-        # Find all UserEventBindings where the sheet_name matches one of the person names
         users_to_sync_bindings = UserEventBinding.objects.filter(
-            sheet_name__in=sheet_person_names)
+            sheet_name__in=sheet_person_names).select_related(
+                'user_profile__user', 'user_profile__calendarconfig')
 
         for binding in users_to_sync_bindings:
             user_profile = binding.user_profile
-            stdout.write(style.HTTP_INFO(
-                f"Attempting sync for user '{user_profile.user.username}' for event '{sheet_event.title}'..."))
+            with profiler.unit('user', f'{user_profile.user.username} (series {series.pk})'):
+                try:
+                    # Raises CalendarConfig.DoesNotExist without a configuration
+                    calendar_config = user_profile.calendarconfig
+                    if not calendar_config.push_enabled or \
+                            calendar_config.validation_status == CalendarConfig.VALIDATION_FAILED:
+                        continue
+                    caldav_service = CalDAVService(
+                        calendar_config.caldav_url,
+                        calendar_config.caldav_username,
+                        calendar_config.caldav_password,
+                        calendar_url=calendar_config.calendar_url or None
+                    )
+
+                    # Claimed with its final UID before the write, see _claim_caldav_events
+                    user_caldav_series, created = UserCalDAVSeries.objects.get_or_create(
+                        user_profile=user_profile, series=series,
+                        defaults={'caldav_uid': new_series_uid(series)})
+                    operation = 'create_series' if created else 'update_series'
+                    start = time.perf_counter()
+                    if created:
+                        try:
+                            caldav_uid = caldav_service.create_series(
+                                series, occurrences, user_caldav_series.caldav_uid)
+                        except Exception:
+                            user_caldav_series.delete()
+                            raise
+                        self._detail(
+                            f"User {user_profile.user.username}: Successfully created CalDAV series '{series.title}' (UID: {caldav_uid})", self.style.SUCCESS)
+                    else:
+                        caldav_uid = caldav_service.update_series(
+                            user_caldav_series.caldav_uid, series, occurrences)
+                        user_caldav_series.caldav_uid = caldav_uid
+                        user_caldav_series.save()
+                        self._detail(
+                            f"User {user_profile.user.username}: Successfully updated CalDAV series '{series.title}'", self.style.SUCCESS)
+                    self.summary['caldav_written'] += 1
+                    self.run_log.record(operation, 'ok', user=user_profile.user.username, uid=caldav_uid,
+                                        duration=time.perf_counter() - start)
+
+                except CalendarConfig.DoesNotExist:
+                    self._detail(
+                        f"User {user_profile.user.username}: No CalDAV config found. Skipping series '{series.title}'.", self.style.WARNING)
+                except Exception as e:
+                    self.summary['caldav_failed'] += 1
+                    self.run_log.record('sync_series', 'error', user=user_profile.user.username, error=e)
+                    self._error(
+                        f"User {user_profile.user.username}: Error during CalDAV sync of series '{series.title}': {e}")
+
+    def _delete_series_from_users_calendars(self, series):
+        """
+        Deletes the recurring event of an EventSeries from all users' calendars.
+        """
+        self._delete_user_caldav_series(UserCalDAVSeries.objects.filter(series=series))
+
+    def _delete_user_caldav_series(self, user_caldav_series_list):
+        """
+        Deletes the given UserCalDAVSeries from CalDAV and, where that worked,
+        from the database.
+        """
+        for user_caldav_series in user_caldav_series_list.select_related(
+                'user_profile__user', 'user_profile__calendarconfig', 'series'):
+            user_profile = user_caldav_series.user_profile
+            series = user_caldav_series.series
+            start = time.perf_counter()
             try:
-                calendar_config = CalendarConfig.objects.get(
-                    user_profile=user_profile)
+                calendar_config = user_profile.calendarconfig
                 caldav_service = CalDAVService(
                     calendar_config.caldav_url,
                     calendar_config.caldav_username,
-                    calendar_config.caldav_password
+                    calendar_config.caldav_password,
+                    calendar_url=calendar_config.calendar_url or None
                 )
-
-                user_caldav_event, created = UserCalDAVEvent.objects.get_or_create(
-                    user_profile=user_profile,
-                    sheet_event=sheet_event,
-                    # Temp empty, will be filled upon creation
-                    defaults={'caldav_uid': ''}
-                )
-
-                if created or not user_caldav_event.caldav_uid:
-                    # Event not yet synced for this user, or UID is missing
-                    stdout.write(style.SUCCESS(
-                        f"User {user_profile.user.username}: Creating new CalDAV event for '{sheet_event.title}'"))
-                    try:
-                        caldav_uid = caldav_service.create_event(sheet_event)
-                        user_caldav_event.caldav_uid = caldav_uid
-                        user_caldav_event.save()
-                        stdout.write(style.SUCCESS(
-                            f"User {user_profile.user.username}: Successfully created CalDAV event '{sheet_event.title}' (UID: {caldav_uid})"))
-                    except Exception as e:
-                        stdout.write(style.ERROR(
-                            f"User {user_profile.user.username}: Failed to create CalDAV event for '{sheet_event.title}': {e}"))
-                else:
-                    # Event already exists, update it
-                    stdout.write(style.SUCCESS(
-                        f"User {user_profile.user.username}: Updating CalDAV event for '{sheet_event.title}' (UID: {user_caldav_event.caldav_uid})"))
-                    try:
-                        caldav_service.update_event(
-                            user_caldav_event.caldav_uid, sheet_event)
-                        stdout.write(style.SUCCESS(
-                            f"User {user_profile.user.username}: Successfully updated CalDAV event '{sheet_event.title}'"))
-                    except Exception as e:
-                        stdout.write(style.ERROR(
-                            f"User {user_profile.user.username}: Failed to update CalDAV event for '{sheet_event.title}' (UID: {user_caldav_event.caldav_uid}): {e}"))
-
+                caldav_service.delete_event(user_caldav_series.caldav_uid)
+                user_caldav_series.delete()
+                self.summary['caldav_deleted'] += 1
+                self.run_log.record('delete_series', 'ok', user=user_profile.user.username,
+                                    uid=user_caldav_series.caldav_uid, duration=time.perf_counter() - start)
+                self._detail(
+                    f"User {user_profile.user.username}: Successfully deleted CalDAV series '{series.title}'.", self.style.SUCCESS)
             except CalendarConfig.DoesNotExist:
-                stdout.write(style.WARNING(
-                    f"User {user_profile.user.username}: No CalDAV config found. Skipping event '{sheet_event.title}'."))
+                self._detail(
+                    f"User {user_profile.user.username}: No CalDAV config found for deleting series '{series.title}'.", self.style.WARNING)
             except Exception as e:
-                stdout.write(style.ERROR(
-                    f"User {user_profile.user.username}: General error during CalDAV sync for '{sheet_event.title}': {e}"))
+                self.summary['caldav_failed'] += 1
+                self.run_log.record('delete_series', 'error', user=user_profile.user.username,
+                                    uid=user_caldav_series.caldav_uid, duration=time.perf_counter() - start, error=e)
+                self._error(
+                    f"User {user_profile.user.username}: Error deleting CalDAV series '{series.title}': {e}")
 
-    def _delete_sheet_event_from_users_calendars(self, sheet_event, stdout, style):
+    def _users_to_push(self, sheet_events, pairs=None):
         """
-        Deletes a SheetEvent from all relevant users' calendars.
+        Yields (user_profile, caldav_service, sheet_events) for every user with
+        push enabled who is assigned some of the given SheetEvents, loading all
+        bindings in one query. `pairs` of (user_profile_id, sheet_event_id),
+        if given, limit the events of each user to those pairs.
         """
-        # Find all UserCalDAVEvent entries related to this sheet_event
-        user_caldav_events_to_delete = UserCalDAVEvent.objects.filter(
-            sheet_event=sheet_event)
-
-        if not user_caldav_events_to_delete.exists():
-            stdout.write(style.WARNING(
-                f"No CalDAV events tracked for sheet event '{sheet_event.title}' for deletion."))
+        events_by_name = {}
+        for sheet_event in sheet_events:
+            for name in sheet_event.person_names():
+                if name.strip():
+                    events_by_name.setdefault(name.strip(), []).append(sheet_event)
+        # If no names are assigned to the events, there's no one to sync them to.
+        if not events_by_name:
             return
 
-        for user_caldav_event in user_caldav_events_to_delete:
-            user_profile = user_caldav_event.user_profile
-            stdout.write(style.HTTP_INFO(
-                f"Attempting deletion for user '{user_profile.user.username}' for event '{sheet_event.title}'..."))
+        # A user may be bound to several names
+        users = {}
+        for binding in UserEventBinding.objects.filter(
+                sheet_name__in=list(events_by_name)).select_related(
+                    'user_profile__user', 'user_profile__calendarconfig'):
+            user_profile, user_events = users.setdefault(binding.user_profile_id, (binding.user_profile, {}))
+            for sheet_event in events_by_name[binding.sheet_name]:
+                if pairs is None or (binding.user_profile_id, sheet_event.pk) in pairs:
+                    user_events[sheet_event.pk] = sheet_event
+
+        for user_profile, user_events in users.values():
+            if not user_events:
+                continue
             try:
-                calendar_config = CalendarConfig.objects.get(
-                    user_profile=user_profile)
-                caldav_service = CalDAVService(
-                    calendar_config.caldav_url,
-                    calendar_config.caldav_username,
-                    calendar_config.caldav_password
-                )
-                stdout.write(style.WARNING(
-                    f"User {user_profile.user.username}: Deleting CalDAV event for '{sheet_event.title}' (UID: {user_caldav_event.caldav_uid})"))
-                caldav_service.delete_event(user_caldav_event.caldav_uid)
-                user_caldav_event.delete()  # Remove from our tracking table
-                stdout.write(style.SUCCESS(
-                    f"User {user_profile.user.username}: Successfully deleted CalDAV event '{sheet_event.title}'."))
+                # Raises CalendarConfig.DoesNotExist without a configuration
+                calendar_config = user_profile.calendarconfig
             except CalendarConfig.DoesNotExist:
-                stdout.write(style.WARNING(
-                    f"User {user_profile.user.username}: No CalDAV config found for deleting event '{sheet_event.title}'."))
-            except Exception as e:
-                stdout.write(style.ERROR(
-                    f"User {user_profile.user.username}: Error deleting CalDAV event for '{sheet_event.title}': {e}"))
+                self._detail(
+                    f"User {user_profile.user.username}: No CalDAV config found. Skipping {len(user_events)} events.", self.style.WARNING)
+                continue
+            if not calendar_config.push_enabled:
+                # User subscribes to the iCalendar feed instead
+                continue
+            if calendar_config.validation_status == CalendarConfig.VALIDATION_FAILED:
+                self._detail(
+                    f"User {user_profile.user.username}: CalDAV connection check failed. Skipping {len(user_events)} events.", self.style.WARNING)
+                continue
+            caldav_service = CalDAVService(
+                calendar_config.caldav_url,
+                calendar_config.caldav_username,
+                calendar_config.caldav_password,
+                calendar_url=calendar_config.calendar_url or None
+            )
+            yield user_profile, caldav_service, list(user_events.values())
+
+    def _claim_caldav_events(self, user_profile, sheet_events):
+        """
+        Returns the user's UserCalDAVEvents of the sheet events by sheet event
+        PK, and the UIDs this run claimed and must create in CalDAV.
+        Missing rows are inserted with their final UID before anything is
+        written to CalDAV. Of two overlapping runs only one inserts a row; the
+        other writes under the same UID, which names the same resource, so no
+        duplicate.
+        """
+        mappings = {mapping.sheet_event_id: mapping for mapping in UserCalDAVEvent.objects.filter(
+            user_profile=user_profile, sheet_event__in=sheet_events)}
+        claimed_uids = set()
+        missing = [sheet_event for sheet_event in sheet_events if sheet_event.pk not in mappings]
+        if missing:
+            new_mappings = [UserCalDAVEvent(user_profile=user_profile, sheet_event=sheet_event,
+                                            caldav_uid=new_sheet_event_uid(sheet_event))
+                            for sheet_event in missing]
+            UserCalDAVEvent.objects.bulk_create(new_mappings, ignore_conflicts=True)
+            claimed_uids.update(mapping.caldav_uid for mapping in new_mappings)
+            mappings.update((mapping.sheet_event_id, mapping) for mapping in UserCalDAVEvent.objects.filter(
+                user_profile=user_profile, sheet_event__in=missing))
+
+        for mapping in mappings.values():
+            if not mapping.caldav_uid:
+                # Empty placeholder of an older version, claimed by whoever fills it first
+                caldav_uid = new_sheet_event_uid(mapping.sheet_event)
+                if UserCalDAVEvent.objects.filter(
+                        pk=mapping.pk, caldav_uid='').update(caldav_uid=caldav_uid):
+                    claimed_uids.add(caldav_uid)
+                mapping.refresh_from_db(fields=['caldav_uid'])
+        return mappings, claimed_uids
+
+    def _sync_sheet_events_to_users_calendars(self, sheet_events, pairs=None):
+        """
+        Creates or updates SheetEvents in the calendars of all relevant users,
+        or only of the given (user_profile_id, sheet_event_id) pairs, as one
+        batch of CalDAV writes per user. The bookkeeping of a batch is
+        committed in one transaction.
+        """
+        for user_profile, caldav_service, user_events in self._users_to_push(sheet_events, pairs):
+            username = user_profile.user.username
+            self._renew_lease()
+            with profiler.unit('user', username):
+                try:
+                    mappings, claimed_uids = self._claim_caldav_events(user_profile, user_events)
+                    events_by_uid = {mappings[sheet_event.pk].caldav_uid: sheet_event
+                                     for sheet_event in user_events}
+                    results = caldav_service.put_events(list(events_by_uid.items()))
+                except Exception as e:
+                    self._error(
+                        f"User {username}: General error during CalDAV sync of {len(user_events)} events: {e}")
+                    continue
+
+                for result in results:
+                    action = 'create' if result.uid in claimed_uids else 'update'
+                    self.run_log.record(
+                        action, 'ok' if result.ok else 'error', event_id=events_by_uid[result.uid].event_id_in_sheet,
+                        user=username, uid=result.uid, duration=result.duration, error=result.error)
+                    if not result.ok:
+                        self._error(
+                            f"User {username}: Failed to {action} CalDAV event for "
+                            f"'{events_by_uid[result.uid].title}' (UID: {result.uid}): {result.error}")
+                synced_uids = [result.uid for result in results if result.ok]
+                # Give up failed claims, the next run creates those events
+                released_uids = [result.uid for result in results
+                                 if not result.ok and result.uid in claimed_uids]
+                with transaction.atomic():
+                    UserCalDAVEvent.objects.filter(caldav_uid__in=synced_uids).update(
+                        last_synced=timezone.now())
+                    if released_uids:
+                        UserCalDAVEvent.objects.filter(caldav_uid__in=released_uids).delete()
+
+                created = len(claimed_uids.intersection(synced_uids))
+                self.summary['caldav_written'] += len(synced_uids)
+                self.summary['caldav_failed'] += len(results) - len(synced_uids)
+                self._detail(
+                    f"User {username}: Created {created} and updated {len(synced_uids) - created} CalDAV events, "
+                    f"{len(results) - len(synced_uids)} failed.", self.style.SUCCESS)
+
+    def _delete_sheet_events_from_users_calendars(self, sheet_events):
+        """
+        Deletes SheetEvents from all relevant users' calendars, as one batch
+        of CalDAV deletions per user.
+        """
+        self._delete_user_caldav_events(UserCalDAVEvent.objects.filter(sheet_event__in=sheet_events))
+
+    def _delete_user_caldav_events(self, user_caldav_events):
+        """
+        Deletes the given UserCalDAVEvents from CalDAV and, where that worked,
+        from the database, as one batch of CalDAV deletions per user.
+        """
+        mappings_by_user = {}
+        for user_caldav_event in user_caldav_events.select_related(
+                'user_profile__user', 'user_profile__calendarconfig', 'sheet_event'):
+            mappings_by_user.setdefault(user_caldav_event.user_profile_id, []).append(user_caldav_event)
+
+        for user_caldav_events in mappings_by_user.values():
+            user_profile = user_caldav_events[0].user_profile
+            username = user_profile.user.username
+            self._renew_lease()
+            with profiler.unit('user', username):
+                try:
+                    # Raises CalendarConfig.DoesNotExist without a configuration
+                    calendar_config = user_profile.calendarconfig
+                    caldav_service = CalDAVService(
+                        calendar_config.caldav_url,
+                        calendar_config.caldav_username,
+                        calendar_config.caldav_password,
+                        calendar_url=calendar_config.calendar_url or None
+                    )
+                    results = caldav_service.delete_events(
+                        [user_caldav_event.caldav_uid for user_caldav_event in user_caldav_events])
+                except CalendarConfig.DoesNotExist:
+                    self._detail(
+                        f"User {username}: No CalDAV config found for deleting {len(user_caldav_events)} events.", self.style.WARNING)
+                    continue
+                except Exception as e:
+                    self._error(
+                        f"User {username}: Error deleting {len(user_caldav_events)} CalDAV events: {e}")
+                    continue
+
+                sheet_events_by_uid = {user_caldav_event.caldav_uid: user_caldav_event.sheet_event
+                                       for user_caldav_event in user_caldav_events}
+                for result in results:
+                    self.run_log.record(
+                        'delete', 'ok' if result.ok else 'error',
+                        event_id=sheet_events_by_uid[result.uid].event_id_in_sheet,
+                        user=username, uid=result.uid, duration=result.duration, error=result.error)
+                    if not result.ok:
+                        self._error(
+                            f"User {username}: Error deleting CalDAV event for '{sheet_events_by_uid[result.uid].title}' "
+                            f"(UID: {result.uid}): {result.error}")
+                deleted_uids = [result.uid for result in results if result.ok]
+                # Remove from our tracking table
+                UserCalDAVEvent.objects.filter(caldav_uid__in=deleted_uids).delete()
+                self.summary['caldav_deleted'] += len(deleted_uids)
+                self.summary['caldav_failed'] += len(results) - len(deleted_uids)
+                self._detail(
+                    f"User {username}: Deleted {len(deleted_uids)} CalDAV events, "
+                    f"{len(results) - len(deleted_uids)} failed.", self.style.SUCCESS)
@@ -0,0 +1,85 @@
+import datetime
+import io
+import secrets
+import uuid
+
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Q
+from django.utils import timezone
+from core.models import SheetSource
+from core.services import GoogleDriveService
+from core.tasks import sync_due_sources
+
+# Channels expiring within this time are replaced
+CHANNEL_RENEWAL_MARGIN = datetime.timedelta(hours=1)
+
+
+class Command(BaseCommand):
+    help = ('Syncs sheets with pending Drive change notifications and polls the others at the '
+            'slow fallback interval. Meant to run from cron every minute or so, '
+            'notified changes wait for it.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--renew_channels', action='store_true',
+                            help='Open Drive notification channels for sheets whose channel is '
+                                 'missing or about to expire (needs DRIVE_WEBHOOK_URL).')
+
+    def handle(self, *args, **options):
+        if options['renew_channels']:
+            self._renew_channels()
+
+        # The web process only records notifications, the syncs run here
+        for spreadsheet_id in sync_due_sources():
+            self.stdout.write(self.style.SUCCESS(f"Synced notified sheet {spreadsheet_id}."))
+
+        fallback_interval = datetime.timedelta(
+            seconds=getattr(settings, 'SHEET_FALLBACK_POLL_SECONDS', 60 * 60 * 6))
+        stale = SheetSource.objects.filter(
+            Q(last_synced_at__isnull=True) | Q(last_synced_at__lte=timezone.now() - fallback_interval))
+        for source in stale:
+            call_command('poll_sheet', spreadsheet_id=source.spreadsheet_id,
+                         range_name=source.range_name, stdout=io.StringIO())
+            self.stdout.write(self.style.SUCCESS(f"Polled sheet {source.spreadsheet_id} (fallback)."))
+
+    def _renew_channels(self):
+        address = getattr(settings, 'DRIVE_WEBHOOK_URL', None)
+        if not address:
+            raise CommandError('DRIVE_WEBHOOK_URL is not set.')
+        ttl = datetime.timedelta(seconds=getattr(settings, 'DRIVE_CHANNEL_TTL_SECONDS', 60 * 60 * 24))
+        drive_service = GoogleDriveService()
+
+        expiring = SheetSource.objects.filter(
+            Q(channel_expiration__isnull=True) |
+            Q(channel_expiration__lte=timezone.now() + CHANNEL_RENEWAL_MARGIN))
+        for source in expiring:
+            channel_id = str(uuid.uuid4())
+            channel_token = secrets.token_urlsafe(32)
+            try:
+                resource_id, expiration = drive_service.watch_file(
+                    source.spreadsheet_id, channel_id, channel_token, address, timezone.now() + ttl)
+            except Exception as e:
+                self.stdout.write(self.style.ERROR(
+                    f"Sheet {source.spreadsheet_id}: Failed to open a notification channel: {e}"))
+                continue
+
+            old_channel_id, old_resource_id = source.channel_id, source.channel_resource_id
+            source.channel_id = channel_id
+            source.channel_token = channel_token
+            source.channel_resource_id = resource_id
+            source.channel_expiration = expiration
+            source.save(update_fields=['channel_id', 'channel_token',
+                                       'channel_resource_id', 'channel_expiration'])
+            self.stdout.write(self.style.SUCCESS(
+                f"Sheet {source.spreadsheet_id}: Notification channel open until {expiration}."))
+
+            # The new channel is open before the old one is stopped, so no change
+            # goes unnoticed. Notifications still arriving on the old channel are
+            # answered with a 404, the new one reports the same changes.
+            if old_channel_id:
+                try:
+                    drive_service.stop_channel(old_channel_id, old_resource_id)
+                except Exception as e:
+                    self.stdout.write(self.style.WARNING(
+                        f"Sheet {source.spreadsheet_id}: Failed to stop the old channel: {e}"))
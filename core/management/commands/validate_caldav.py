@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+from core.models import CalendarConfig
+from core.tasks import validate_calendar_config
+
+
+class Command(BaseCommand):
+    help = 'Checks CalDAV configurations whose background connection check has not completed.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true',
+                            help='Check every configuration, not only pending ones.')
+
+    def handle(self, *args, **options):
+        configs = CalendarConfig.objects.select_related('user_profile__user')
+        if not options['all']:
+            configs = configs.filter(validation_status__in=[
+                CalendarConfig.VALIDATION_PENDING, CalendarConfig.VALIDATION_RUNNING])
+
+        for config in configs:
+            username = config.user_profile.user.username
+            status = validate_calendar_config(config.pk)
+            if status == CalendarConfig.VALIDATION_OK:
+                self.stdout.write(self.style.SUCCESS(
+                    f"User {username}: CalDAV connection successful."))
+            else:
+                config.refresh_from_db(fields=['validation_error'])
+                self.stdout.write(self.style.ERROR(
+                    f"User {username}: Failed to connect to CalDAV server: {config.validation_error}"))
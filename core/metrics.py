@@ -0,0 +1,162 @@
+import json
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+from django.utils import timezone
+
+# Upper bounds in seconds, chosen for HTTP round trips and DB statements
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# Span phases reported by the sync
+PHASE_SHEETS_FETCH = 'sheets_fetch'
+PHASE_PARSE = 'parse'
+PHASE_DB_UPSERT = 'db_upsert'
+PHASE_CALDAV = 'caldav'
+PHASE_CALDAV_REQUEST = 'caldav_request'
+
+
+class MetricsRecorder:
+    """
+    Collects counters and latency histograms, keyed by metric name and labels.
+    Thread safe, as CalDAV checks run in background threads.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.started_at = timezone.now()
+            self._started = time.perf_counter()
+            self._counters = {}
+            self._histograms = {}
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted((key, str(value)) for key, value in labels.items() if value is not None))
+
+    def inc(self, name, amount=1, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = {
+                    'buckets': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    histogram['buckets'][i] += 1
+            histogram['sum'] += value
+            histogram['count'] += 1
+
+    @contextmanager
+    def span(self, phase, **labels):
+        """
+        Times the enclosed block as one operation of the given phase.
+        The outcome label is 'error' when the block raises, 'ok' otherwise.
+        """
+        outcome = 'ok'
+        start = time.perf_counter()
+        try:
+            yield
+        except BaseException:
+            outcome = 'error'
+            raise
+        finally:
+            duration = time.perf_counter() - start
+            self.observe('cal_sync_span_duration_seconds', duration,
+                         phase=phase, outcome=outcome, **labels)
+
+    def report(self):
+        """JSON serialisable snapshot of everything recorded since the last reset."""
+        with self._lock:
+            return {
+                'started_at': self.started_at.isoformat(),
+                'finished_at': timezone.now().isoformat(),
+                'duration_seconds': time.perf_counter() - self._started,
+                'buckets': list(self.buckets),
+                'counters': [
+                    {'name': name, 'labels': dict(labels), 'value': value}
+                    for (name, labels), value in sorted(self._counters.items())
+                ],
+                'histograms': [
+                    {'name': name, 'labels': dict(labels), 'buckets': list(histogram['buckets']),
+                     'sum': histogram['sum'], 'count': histogram['count']}
+                    for (name, labels), histogram in sorted(self._histograms.items())
+                ],
+            }
+
+    def write_report(self, path):
+        """Writes the report as JSON, replacing the file at once so readers never see half of it."""
+        report = self.report()
+        directory, name = os.path.split(os.path.abspath(path))
+        fd, temp_path = tempfile.mkstemp(prefix=f'.{name}.', dir=directory)
+        try:
+            with os.fdopen(fd, 'w') as report_file:
+                json.dump(report, report_file, indent=2)
+            # mkstemp creates it private, the web process must be able to read it
+            os.chmod(temp_path, 0o644)
+            os.replace(temp_path, path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+        return report
+
+
+# Process wide recorder used by the services and the poll
+metrics = MetricsRecorder()
+
+
+def _escape_label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{_escape_label_value(value)}"' for key, value in sorted(labels.items())) + '}'
+
+
+def render_prometheus(reports):
+    """
+    Renders reports in the Prometheus text exposition format.
+    `reports` maps a source name (e.g. 'last_run', 'web') to a report dict;
+    the source is added as a label so series of different processes don't clash.
+    """
+    counters = {}
+    histograms = {}
+    lines = []
+    for source, report in reports.items():
+        for counter in report['counters']:
+            counters.setdefault(counter['name'], []).append(
+                (dict(counter['labels'], source=source), counter['value']))
+        for histogram in report['histograms']:
+            histograms.setdefault(histogram['name'], []).append(
+                (dict(histogram['labels'], source=source), histogram, report['buckets']))
+        lines.append(
+            f'cal_sync_report_duration_seconds{_format_labels({"source": source})} {report["duration_seconds"]}')
+
+    lines.insert(0, '# TYPE cal_sync_report_duration_seconds gauge')
+    for name, series in sorted(counters.items()):
+        lines.append(f'# TYPE {name} counter')
+        for labels, value in series:
+            lines.append(f'{name}{_format_labels(labels)} {value}')
+    for name, series in sorted(histograms.items()):
+        lines.append(f'# TYPE {name} histogram')
+        for labels, histogram, buckets in series:
+            # Bucket counts are already cumulative, see MetricsRecorder.observe
+            for bound, count in zip(buckets, histogram['buckets']):
+                lines.append(f'{name}_bucket{_format_labels(dict(labels, le=str(bound)))} {count}')
+            lines.append(f'{name}_bucket{_format_labels(dict(labels, le="+Inf"))} {histogram["count"]}')
+            lines.append(f'{name}_sum{_format_labels(labels)} {histogram["sum"]}')
+            lines.append(f'{name}_count{_format_labels(labels)} {histogram["count"]}')
+    return '\n'.join(lines) + '\n'
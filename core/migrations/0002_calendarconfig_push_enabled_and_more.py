@@ -0,0 +1,33 @@
+# Generated by Django 5.2.18 on 2026-10-19 07:43
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='calendarconfig',
+            name='push_enabled',
+            field=models.BooleanField(default=True, help_text='Write events into this calendar. Disable when subscribing to the iCalendar feed instead.'),
+        ),
+        migrations.AddField(
+            model_name='userprofile',
+            name='events_changed_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='userprofile',
+            name='events_version',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='userprofile',
+            name='feed_token',
+            field=models.CharField(blank=True, help_text='Secret token authenticating the iCalendar feed URL.', max_length=64, null=True, unique=True),
+        ),
+    ]
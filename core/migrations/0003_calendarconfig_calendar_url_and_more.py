@@ -0,0 +1,38 @@
+# Generated by Django 5.2.18 on 2026-10-19 07:44
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0002_calendarconfig_push_enabled_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='calendarconfig',
+            name='calendar_url',
+            field=models.URLField(blank=True),
+        ),
+        migrations.AddField(
+            model_name='calendarconfig',
+            name='discovered_calendars',
+            field=models.JSONField(blank=True, default=list),
+        ),
+        migrations.AddField(
+            model_name='calendarconfig',
+            name='validated_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='calendarconfig',
+            name='validation_error',
+            field=models.TextField(blank=True),
+        ),
+        migrations.AddField(
+            model_name='calendarconfig',
+            name='validation_status',
+            field=models.CharField(choices=[('pending', 'Pending'), ('running', 'Running'), ('ok', 'Connected'), ('failed', 'Failed')], default='pending', max_length=16),
+        ),
+    ]
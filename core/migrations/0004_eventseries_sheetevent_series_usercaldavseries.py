@@ -0,0 +1,50 @@
+# Generated by Django 5.2.18 on 2026-10-19 07:53
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0003_calendarconfig_calendar_url_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EventSeries',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('series_key', models.CharField(help_text='Hash of the shared title, assignees, duration, time of day and interval.', max_length=64, unique=True)),
+                ('title', models.CharField(max_length=255)),
+                ('description', models.TextField(blank=True)),
+                ('start_time', models.DateTimeField()),
+                ('end_time', models.DateTimeField()),
+                ('interval_days', models.PositiveIntegerField()),
+                ('count', models.PositiveIntegerField()),
+                ('exdates', models.JSONField(blank=True, default=list)),
+                ('person1_name', models.CharField(blank=True, max_length=255, null=True)),
+                ('person2_name', models.CharField(blank=True, max_length=255, null=True)),
+                ('person3_name', models.CharField(blank=True, max_length=255, null=True)),
+                ('person4_name', models.CharField(blank=True, max_length=255, null=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='sheetevent',
+            name='series',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='occurrences', to='core.eventseries'),
+        ),
+        migrations.CreateModel(
+            name='UserCalDAVSeries',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('caldav_uid', models.CharField(help_text='The UID of the recurring event in the CalDAV calendar.', max_length=255, unique=True)),
+                ('last_synced', models.DateTimeField(auto_now=True)),
+                ('series', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='core.eventseries')),
+                ('user_profile', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='core.userprofile')),
+            ],
+            options={
+                'unique_together': {('user_profile', 'series')},
+            },
+        ),
+    ]
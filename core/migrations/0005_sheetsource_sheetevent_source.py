@@ -0,0 +1,34 @@
+# Generated by Django 5.2.18 on 2026-10-19 07:55
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0004_eventseries_sheetevent_series_usercaldavseries'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SheetSource',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('spreadsheet_id', models.CharField(max_length=255, unique=True)),
+                ('range_name', models.CharField(default='Sheet1!A:I', max_length=255)),
+                ('channel_id', models.CharField(blank=True, max_length=64)),
+                ('channel_token', models.CharField(blank=True, help_text='Secret Drive echoes in X-Goog-Channel-Token.', max_length=64)),
+                ('channel_resource_id', models.CharField(blank=True, max_length=255)),
+                ('channel_expiration', models.DateTimeField(blank=True, null=True)),
+                ('sync_requested_at', models.DateTimeField(blank=True, null=True)),
+                ('last_notified_at', models.DateTimeField(blank=True, null=True)),
+                ('last_synced_at', models.DateTimeField(blank=True, null=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='sheetevent',
+            name='source',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='core.sheetsource'),
+        ),
+    ]
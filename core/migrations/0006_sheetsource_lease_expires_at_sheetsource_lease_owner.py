@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-19 08:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0005_sheetsource_sheetevent_source'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='sheetsource',
+            name='lease_expires_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='sheetsource',
+            name='lease_owner',
+            field=models.CharField(blank=True, max_length=255),
+        ),
+    ]
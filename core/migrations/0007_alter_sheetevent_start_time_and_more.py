@@ -0,0 +1,28 @@
+# Generated by Django 5.2.18 on 2026-10-19 08:08
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0006_sheetsource_lease_expires_at_sheetsource_lease_owner'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='sheetevent',
+            name='start_time',
+            field=models.DateTimeField(db_index=True),
+        ),
+        migrations.AlterField(
+            model_name='usercaldavevent',
+            name='last_synced',
+            field=models.DateTimeField(auto_now=True, db_index=True),
+        ),
+        migrations.AlterField(
+            model_name='usereventbinding',
+            name='sheet_name',
+            field=models.CharField(db_index=True, help_text='The name as it appears in the Google Sheet for this user', max_length=255),
+        ),
+    ]
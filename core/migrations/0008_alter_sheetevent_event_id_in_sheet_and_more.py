@@ -0,0 +1,36 @@
+# Generated by Django 5.2.18 on 2026-10-19 08:22
+
+from django.db import migrations, models
+
+
+def assign_single_source(apps, schema_editor):
+    """
+    Events stored before sources were tracked belong to the only
+    spreadsheet, if there is just one. Otherwise the next poll of their
+    spreadsheet adopts them.
+    """
+    SheetSource = apps.get_model('core', 'SheetSource')
+    SheetEvent = apps.get_model('core', 'SheetEvent')
+    sources = list(SheetSource.objects.all()[:2])
+    if len(sources) == 1:
+        SheetEvent.objects.filter(source__isnull=True).update(source=sources[0])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0007_alter_sheetevent_start_time_and_more'),
+    ]
+
+    operations = [
+        migrations.RunPython(assign_single_source, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='sheetevent',
+            name='event_id_in_sheet',
+            field=models.CharField(db_index=True, help_text='A unique identifier for the event within its sheet (e.g., row number, custom ID)', max_length=255),
+        ),
+        migrations.AlterUniqueTogether(
+            name='sheetevent',
+            unique_together={('source', 'event_id_in_sheet')},
+        ),
+    ]
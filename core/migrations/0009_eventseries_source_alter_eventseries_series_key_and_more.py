@@ -0,0 +1,40 @@
+# Generated by Django 5.2.18 on 2026-10-19 08:48
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def assign_occurrence_source(apps, schema_editor):
+    """Series belong to the spreadsheet of their occurrences."""
+    EventSeries = apps.get_model('core', 'EventSeries')
+    SheetEvent = apps.get_model('core', 'SheetEvent')
+    for series in EventSeries.objects.filter(source__isnull=True):
+        source_id = SheetEvent.objects.filter(series=series, source__isnull=False).values_list(
+            'source_id', flat=True).first()
+        if source_id is not None:
+            EventSeries.objects.filter(pk=series.pk).update(source_id=source_id)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0008_alter_sheetevent_event_id_in_sheet_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='eventseries',
+            name='source',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='core.sheetsource'),
+        ),
+        migrations.RunPython(assign_occurrence_source, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='eventseries',
+            name='series_key',
+            field=models.CharField(help_text='Hash of the shared title, assignees, duration, time of day and interval.', max_length=64),
+        ),
+        migrations.AlterUniqueTogether(
+            name='eventseries',
+            unique_together={('source', 'series_key')},
+        ),
+    ]
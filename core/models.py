@@ -1,37 +1,175 @@
 # core/models.py
+import secrets
+
 from django.db import models
+from django.db.models import F, Q
 from django.contrib.auth.models import User
 from django.utils import timezone
 
 
+class UserProfileQuerySet(models.QuerySet):
+    def bump_events_version(self):
+        """
+        Marks the assigned events of these profiles as changed.
+        Invalidates cached feeds/pages and the ETags handed out for them.
+        """
+        return self.update(events_version=F('events_version') + 1,
+                           events_changed_at=timezone.now())
+
+
 class UserProfile(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE)
+    # Secret for the iCalendar subscription feed, generated on first use
+    feed_token = models.CharField(max_length=64, unique=True, null=True, blank=True,
+                                  help_text="Secret token authenticating the iCalendar feed URL.")
+    # Bumped by the poll whenever the events assigned to this user change
+    events_version = models.PositiveIntegerField(default=0)
+    events_changed_at = models.DateTimeField(null=True, blank=True)
+
+    objects = UserProfileQuerySet.as_manager()
+
+    def __str__(self):
+        return self.user.username
+
+    def get_feed_token(self):
+        if not self.feed_token:
+            self.feed_token = secrets.token_urlsafe(32)
+            self.save(update_fields=['feed_token'])
+        return self.feed_token
+
+    def bump_events_version(self):
+        UserProfile.objects.filter(pk=self.pk).bump_events_version()
+        self.refresh_from_db(fields=['events_version', 'events_changed_at'])
+
+
+class SheetEventQuerySet(models.QuerySet):
+    def assigned_to(self, *sheet_names):
+        """Events where any of the person columns matches one of the given names."""
+        return self.filter(Q(person1_name__in=sheet_names) |
+                           Q(person2_name__in=sheet_names) |
+                           Q(person3_name__in=sheet_names) |
+                           Q(person4_name__in=sheet_names))
+
+
+# A spreadsheet the poll reads, with its Drive change notification channel
+class SheetSource(models.Model):
+    spreadsheet_id = models.CharField(max_length=255, unique=True)
+    range_name = models.CharField(max_length=255, default='Sheet1!A:I')
+    # Drive push notification channel, renewed before it expires
+    channel_id = models.CharField(max_length=64, blank=True)
+    channel_token = models.CharField(max_length=64, blank=True,
+                                     help_text="Secret Drive echoes in X-Goog-Channel-Token.")
+    channel_resource_id = models.CharField(max_length=255, blank=True)
+    channel_expiration = models.DateTimeField(null=True, blank=True)
+    # First unprocessed notification, cleared by the sync it triggers
+    sync_requested_at = models.DateTimeField(null=True, blank=True)
+    # Latest notification, syncs wait until the burst has settled
+    last_notified_at = models.DateTimeField(null=True, blank=True)
+    last_synced_at = models.DateTimeField(null=True, blank=True)
+    # Run lease, overlapping polls of the same sheet skip instead of racing
+    lease_owner = models.CharField(max_length=255, blank=True)
+    lease_expires_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return self.spreadsheet_id
+
+    def acquire_lease(self, owner, duration):
+        """
+        Takes or extends the run lease for `owner` unless another owner holds
+        an unexpired one. A single conditional UPDATE, so only one run wins.
+        """
+        now = timezone.now()
+        acquired = SheetSource.objects.filter(pk=self.pk).filter(
+            Q(lease_owner=owner) | Q(lease_expires_at__isnull=True) | Q(lease_expires_at__lte=now)
+        ).update(lease_owner=owner, lease_expires_at=now + duration)
+        return acquired == 1
+
+    def release_lease(self, owner):
+        SheetSource.objects.filter(pk=self.pk, lease_owner=owner).update(
+            lease_owner='', lease_expires_at=None)
+
+
+# Repeating sheet events collapsed into one recurring calendar event
+class EventSeries(models.Model):
+    series_key = models.CharField(max_length=64,
+                                  help_text="Hash of the shared title, assignees, duration, time of day and interval.")
+    # Spreadsheet of the occurrences, the same shift may repeat in several sheets
+    source = models.ForeignKey('SheetSource', on_delete=models.SET_NULL, null=True, blank=True)
+    title = models.CharField(max_length=255)
+    description = models.TextField(blank=True)
+    # First occurrence, the DTSTART of the series
+    start_time = models.DateTimeField()
+    end_time = models.DateTimeField()
+    interval_days = models.PositiveIntegerField()
+    # Number of slots, including the excluded ones
+    count = models.PositiveIntegerField()
+    # Start times (ISO format) of slots without an event in the sheet
+    exdates = models.JSONField(default=list, blank=True)
+    person1_name = models.CharField(max_length=255, blank=True, null=True)
+    person2_name = models.CharField(max_length=255, blank=True, null=True)
+    person3_name = models.CharField(max_length=255, blank=True, null=True)
+    person4_name = models.CharField(max_length=255, blank=True, null=True)
+
+    class Meta:
+        unique_together = ('source', 'series_key')
+
+    def person_names(self):
+        names = [self.person1_name, self.person2_name,
+                 self.person3_name, self.person4_name]
+        return [name for name in names if name]
 
 
 # Duplicate the events from the sheet
 class SheetEvent(models.Model):
+    # Unique per spreadsheet only, see Meta. Indexed for the admin search
     event_id_in_sheet = models.CharField(
-        max_length=255, unique=True, help_text="A unique identifier for the event in the sheet (e.g., row number, custom ID)")
+        max_length=255, db_index=True,
+        help_text="A unique identifier for the event within its sheet (e.g., row number, custom ID)")
     title = models.CharField(max_length=255)
     description = models.TextField(blank=True)
-    start_time = models.DateTimeField()
+    # Indexed for the dashboard window and the admin filter
+    start_time = models.DateTimeField(db_index=True)
     end_time = models.DateTimeField()
     person1_name = models.CharField(max_length=255, blank=True, null=True)
     person2_name = models.CharField(max_length=255, blank=True, null=True)
     person3_name = models.CharField(max_length=255, blank=True, null=True)
     person4_name = models.CharField(max_length=255, blank=True, null=True)
+    # Spreadsheet the event was read from, deletions are scoped to it
+    source = models.ForeignKey(SheetSource, on_delete=models.SET_NULL, null=True, blank=True)
+    # Set when the poll collapses this event into a recurring series
+    series = models.ForeignKey(EventSeries, on_delete=models.SET_NULL, null=True, blank=True,
+                               related_name='occurrences')
+
+    objects = SheetEventQuerySet.as_manager()
+
+    class Meta:
+        # Different spreadsheets may use the same IDs, e.g. row numbers
+        unique_together = ('source', 'event_id_in_sheet')
+
+    def __str__(self):
+        return f'{self.title} ({self.event_id_in_sheet})'
+
+    def person_names(self):
+        """Non-empty person names of this event, as written in the sheet."""
+        names = [self.person1_name, self.person2_name,
+                 self.person3_name, self.person4_name]
+        return [name for name in names if name]
 
 
 # Bind profile to the exact pronuncudoiation in the sheet
 class UserEventBinding(models.Model):
     user_profile = models.ForeignKey(UserProfile, on_delete=models.CASCADE)
+    # Indexed, the sync looks bindings up by the names in the sheet
     sheet_name = models.CharField(
-        max_length=255, help_text="The name as it appears in the Google Sheet for this user")
+        max_length=255, db_index=True, help_text="The name as it appears in the Google Sheet for this user")
 
     class Meta:
         # A user can only bind one sheet name
         unique_together = ('user_profile', 'sheet_name')
 
+    def __str__(self):
+        return self.sheet_name
+
 
 # Bind a user account to CalDAV credentials
 class CalendarConfig(models.Model):
@@ -43,6 +181,28 @@ class CalendarConfig(models.Model):
     caldav_username = models.CharField(max_length=255)
     # Encryption?
     caldav_password = models.CharField(max_length=255)
+    push_enabled = models.BooleanField(
+        default=True, help_text="Write events into this calendar. Disable when subscribing to the iCalendar feed instead.")
+
+    # Connection check, run in the background after every save
+    VALIDATION_PENDING = 'pending'
+    VALIDATION_RUNNING = 'running'
+    VALIDATION_OK = 'ok'
+    VALIDATION_FAILED = 'failed'
+    VALIDATION_CHOICES = [
+        (VALIDATION_PENDING, 'Pending'),
+        (VALIDATION_RUNNING, 'Running'),
+        (VALIDATION_OK, 'Connected'),
+        (VALIDATION_FAILED, 'Failed'),
+    ]
+    validation_status = models.CharField(
+        max_length=16, choices=VALIDATION_CHOICES, default=VALIDATION_PENDING)
+    validation_error = models.TextField(blank=True)
+    validated_at = models.DateTimeField(null=True, blank=True)
+    # Calendars found during the check, as [{'url': ..., 'name': ...}]
+    discovered_calendars = models.JSONField(default=list, blank=True)
+    # Calendar events are written to, so syncs can skip the discovery
+    calendar_url = models.URLField(blank=True)
 
 
 class UserCalDAVEvent(models.Model):
@@ -54,8 +214,26 @@ class UserCalDAVEvent(models.Model):
     sheet_event = models.ForeignKey(SheetEvent, on_delete=models.CASCADE)
     caldav_uid = models.CharField(max_length=255, unique=True,
                                   help_text="The UID of the event in the CalDAV calendar.")
-    last_synced = models.DateTimeField(auto_now=True)
+    last_synced = models.DateTimeField(auto_now=True, db_index=True)
 
     class Meta:
         # A user syncs a sheet event once
         unique_together = ('user_profile', 'sheet_event')
+
+    def __str__(self):
+        return self.caldav_uid
+
+
+class UserCalDAVSeries(models.Model):
+    """
+    Maps an EventSeries to the recurring event written to a user's calendar,
+    the counterpart of UserCalDAVEvent for collapsed events.
+    """
+    user_profile = models.ForeignKey(UserProfile, on_delete=models.CASCADE)
+    series = models.ForeignKey(EventSeries, on_delete=models.CASCADE)
+    caldav_uid = models.CharField(max_length=255, unique=True,
+                                  help_text="The UID of the recurring event in the CalDAV calendar.")
+    last_synced = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ('user_profile', 'series')
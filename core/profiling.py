@@ -0,0 +1,217 @@
+"""
+Query and HTTP profiling per logical unit of work (a sheet row, a user,
+a web request).
+
+Switched on with the SYNC_PROFILING setting, the CAL_SYNC_PROFILE
+environment variable or `poll_sheet --profile`. When off, units cost a
+flag check. Tests can use QueryBudgetMixin regardless of the switch.
+"""
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connection, connections
+from django.test.utils import CaptureQueriesContext
+
+logger = logging.getLogger(__name__)
+
+
+def profiling_enabled():
+    return bool(getattr(settings, 'SYNC_PROFILING', False) or
+                os.environ.get('CAL_SYNC_PROFILE', '').lower() in ('1', 'true', 'yes'))
+
+
+class UnitStats:
+    def __init__(self, kind, key):
+        self.kind = kind
+        self.key = key
+        self.queries = 0
+        self.query_seconds = 0.0
+        self.http_calls = 0
+        self.http_seconds = 0.0
+        self.wall_seconds = 0.0
+
+    def as_dict(self):
+        return {
+            'kind': self.kind, 'key': str(self.key),
+            'queries': self.queries, 'query_seconds': self.query_seconds,
+            'http_calls': self.http_calls, 'http_seconds': self.http_seconds,
+            'wall_seconds': self.wall_seconds,
+        }
+
+
+class Profiler:
+    """
+    Collects UnitStats. Units may nest, e.g. the users synced for a row:
+    queries and HTTP calls count towards every open unit of the thread.
+    """
+
+    def __init__(self):
+        # Profiling of a run, switched by start() and stop()
+        self.recording = False
+        # Set for good by QueryProfilingMiddleware, a run stopping doesn't end it
+        self.always_on = False
+        self.units = []
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.recording or self.always_on
+
+    def start(self):
+        with self._lock:
+            self.units = []
+        self.recording = True
+
+    def stop(self):
+        self.recording = False
+
+    def _stack(self):
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+    @contextmanager
+    def unit(self, kind, key, record=True):
+        """
+        Profiles the enclosed block as one unit. With record=False the stats
+        are only handed to the caller, not kept for the report.
+        """
+        if not self.enabled:
+            yield None
+            return
+
+        stats = UnitStats(kind, key)
+        stack = self._stack()
+        outermost = not stack
+        stack.append(stats)
+        start = time.perf_counter()
+        try:
+            if outermost:
+                with connection.execute_wrapper(self._record_query):
+                    yield stats
+            else:
+                yield stats
+        finally:
+            stats.wall_seconds = time.perf_counter() - start
+            stack.pop()
+            if record:
+                with self._lock:
+                    self.units.append(stats)
+
+    def _record_query(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            duration = time.perf_counter() - start
+            for stats in self._stack():
+                stats.queries += 1
+                stats.query_seconds += duration
+
+    def record_http(self, duration):
+        """Attributes an outgoing HTTP call to the open units of this thread."""
+        if not self.enabled:
+            return
+        # Units may be attached to several worker threads
+        with self._lock:
+            for stats in self._stack():
+                stats.http_calls += 1
+                stats.http_seconds += duration
+
+    def open_units(self):
+        """Units open in this thread, for attach() in worker threads."""
+        return list(self._stack()) if self.enabled else []
+
+    @contextmanager
+    def attach(self, units):
+        """Counts the HTTP calls of this thread towards units opened in another thread."""
+        stack = self._stack()
+        stack.extend(units)
+        try:
+            yield
+        finally:
+            del stack[len(stack) - len(units):]
+
+    def report(self, top=5):
+        """Totals and the most expensive units per kind, by query count and by wall time."""
+        with self._lock:
+            units = list(self.units)
+        kinds = {}
+        for stats in units:
+            kinds.setdefault(stats.kind, []).append(stats)
+        report = {}
+        for kind, kind_units in sorted(kinds.items()):
+            report[kind] = {
+                'units': len(kind_units),
+                'queries': sum(stats.queries for stats in kind_units),
+                'http_calls': sum(stats.http_calls for stats in kind_units),
+                'wall_seconds': sum(stats.wall_seconds for stats in kind_units),
+                'top_by_queries': [stats.as_dict() for stats in
+                                   sorted(kind_units, key=lambda stats: stats.queries, reverse=True)[:top]],
+                'top_by_wall_time': [stats.as_dict() for stats in
+                                     sorted(kind_units, key=lambda stats: stats.wall_seconds, reverse=True)[:top]],
+            }
+        return report
+
+    def format_report(self, top=5):
+        lines = []
+        for kind, summary in self.report(top).items():
+            units = summary['units']
+            lines.append(
+                f"{kind}: {units} units, {summary['queries']} queries "
+                f"({summary['queries'] / units:.1f}/unit), {summary['http_calls']} HTTP calls "
+                f"({summary['http_calls'] / units:.1f}/unit), {summary['wall_seconds']:.2f}s")
+            for stats in summary['top_by_queries']:
+                lines.append(
+                    f"  {stats['key']}: {stats['queries']} queries in {stats['query_seconds'] * 1000:.1f}ms, "
+                    f"{stats['http_calls']} HTTP calls, {stats['wall_seconds'] * 1000:.1f}ms total")
+        return lines
+
+
+# Process wide profiler used by the sync and the middleware
+profiler = Profiler()
+
+
+class QueryProfilingMiddleware:
+    """
+    Profiles every web request as one unit and reports it in a Server-Timing
+    header and the core.profiling log. Only active when profiling is enabled.
+    """
+
+    def __init__(self, get_response):
+        if not profiling_enabled():
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        profiler.always_on = True
+
+    def __call__(self, request):
+        # Not recorded, a long running web process would accumulate them
+        with profiler.unit('request', f'{request.method} {request.path}', record=False) as stats:
+            response = self.get_response(request)
+        response['Server-Timing'] = (
+            f'db;desc="{stats.queries} queries";dur={stats.query_seconds * 1000:.1f}, '
+            f'total;dur={stats.wall_seconds * 1000:.1f}')
+        logger.info('%s %s: %d queries in %.1fms, %d HTTP calls, %.1fms total',
+                    request.method, request.path, stats.queries, stats.query_seconds * 1000,
+                    stats.http_calls, stats.wall_seconds * 1000)
+        return response
+
+
+class QueryBudgetMixin:
+    """TestCase mixin failing when a block runs more SQL queries than budgeted."""
+
+    @contextmanager
+    def assertQueryBudget(self, max_queries, using='default'):
+        with CaptureQueriesContext(connections[using]) as captured:
+            yield captured
+        executed = len(captured.captured_queries)
+        if executed > max_queries:
+            queries = '\n'.join(f"{i}. {query['sql']}" for i, query in
+                                enumerate(captured.captured_queries, start=1))
+            self.fail(f'{executed} queries executed, budget is {max_queries}:\n{queries}')
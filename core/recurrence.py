@@ -0,0 +1,143 @@
+"""
+Detection of repeating sheet events, e.g. the same weekly shift over months.
+
+Events sharing title, assignees, duration and local time of day, and
+starting at a regular day interval, are grouped into an EventSeries.
+Slots of the interval without an event become EXDATEs; occurrences with
+a different description are written as RECURRENCE-ID overrides.
+"""
+import datetime
+import hashlib
+import math
+from collections import Counter, defaultdict
+
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .models import EventSeries, SheetEvent
+
+MIN_OCCURRENCES = 3
+# Series may skip at most this many slots per occurrence
+MAX_MISSING_RATIO = 0.5
+
+
+class DetectedSeries:
+    def __init__(self, key, events, interval_days, count, exdates):
+        self.key = key
+        self.events = events
+        self.interval_days = interval_days
+        self.count = count
+        self.exdates = exdates
+
+    @property
+    def description(self):
+        """Most common description, occurrences differing from it become overrides."""
+        return Counter(event.description for event in self.events).most_common(1)[0][0]
+
+
+def _series_key(*parts):
+    return hashlib.sha256(repr(parts).encode('utf-8')).hexdigest()
+
+
+def _detect_regular(events, base_key, min_occurrences):
+    if len(events) < min_occurrences:
+        return None
+    events = sorted(events, key=lambda event: event.start_time)
+    local_starts = [timezone.localtime(event.start_time) for event in events]
+    dates = [start.date() for start in local_starts]
+    if len(set(dates)) != len(dates):
+        return None
+
+    gaps = [(later - earlier).days for earlier, later in zip(dates, dates[1:])]
+    interval_days = math.gcd(*gaps)
+    count = (dates[-1] - dates[0]).days // interval_days + 1
+    if count - len(events) > len(events) * MAX_MISSING_RATIO:
+        return None
+
+    present = set(dates)
+    exdates = []
+    for slot in range(count):
+        slot_date = dates[0] + datetime.timedelta(days=slot * interval_days)
+        if slot_date not in present:
+            # Same wall clock time on that day, across DST changes
+            exdates.append(timezone.make_aware(
+                datetime.datetime.combine(slot_date, local_starts[0].time())))
+    return DetectedSeries(_series_key(*base_key, interval_days), events, interval_days, count, exdates)
+
+
+def detect_series(sheet_events, min_occurrences=MIN_OCCURRENCES):
+    """Returns the DetectedSeries found among the given SheetEvents."""
+    groups = defaultdict(list)
+    for event in sheet_events:
+        groups[(
+            event.title,
+            tuple(sorted(name.strip() for name in event.person_names())),
+            int((event.end_time - event.start_time).total_seconds()),
+            timezone.localtime(event.start_time).time().isoformat(),
+        )].append(event)
+
+    detected = []
+    for key, events in groups.items():
+        series = _detect_regular(events, key, min_occurrences)
+        if series is None:
+            # e.g. a shift every Monday and Wednesday: one weekly series per weekday
+            by_weekday = defaultdict(list)
+            for event in events:
+                by_weekday[timezone.localtime(event.start_time).weekday()].append(event)
+            for weekday, weekday_events in by_weekday.items():
+                series = _detect_regular(weekday_events, key + (weekday,), min_occurrences)
+                if series is not None:
+                    detected.append(series)
+        else:
+            detected.append(series)
+    return detected
+
+
+@transaction.atomic
+def collapse_recurring_events(sheet_events, source):
+    """
+    Detects series among the SheetEvents of a SheetSource and stores them as
+    EventSeries of that source, pointing the member events to their series
+    and detaching the others.
+    Returns the current series and the source's ones no longer detected; the
+    caller removes those from the calendars and deletes them.
+    """
+    sheet_events = list(sheet_events)
+    series_list = []
+    series_of_event = {}
+    for detected in detect_series(sheet_events):
+        first = detected.events[0]
+        names = first.person_names() + [None] * 4
+        series, created = EventSeries.objects.update_or_create(
+            source=source, series_key=detected.key,
+            defaults={
+                'title': first.title,
+                'description': detected.description,
+                'start_time': first.start_time,
+                'end_time': first.end_time,
+                'interval_days': detected.interval_days,
+                'count': detected.count,
+                'exdates': [exdate.isoformat() for exdate in detected.exdates],
+                'person1_name': names[0],
+                'person2_name': names[1],
+                'person3_name': names[2],
+                'person4_name': names[3],
+            }
+        )
+        series_list.append(series)
+        for event in detected.events:
+            series_of_event[event.pk] = series.pk
+
+    changed = []
+    for event in sheet_events:
+        series_id = series_of_event.get(event.pk)
+        if event.series_id != series_id:
+            event.series_id = series_id
+            changed.append(event)
+    SheetEvent.objects.bulk_update(changed, ['series'])
+
+    # Series stored before sources were tracked are cleaned up by any source
+    stale_series = list(EventSeries.objects.filter(
+        Q(source=source) | Q(source__isnull=True), occurrences__isnull=True))
+    return series_list, stale_series
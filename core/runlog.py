@@ -0,0 +1,70 @@
+"""
+Per-operation log of sync runs as JSON lines, one object per line with
+the same keys on every line, e.g.
+
+    {"ts": "2026-03-02T06:00:00.123+00:00", "run": "3f2a9c1b7d4e", "sheet": "1AbC...",
+     "operation": "update", "outcome": "ok", "row": null, "event_id": "evt-12",
+     "user": "alice", "uid": "django-sheet-event-7-...", "duration_ms": 41.7, "error": null}
+
+Lines are buffered and written in blocks, errors are flushed at once.
+Overlapping runs append to the same file, one write per line, so rotation
+is left to an external tool such as logrotate: the file is reopened when
+it was moved away. Query it with e.g.
+`jq 'select(.outcome == "error")' sync_runs.jsonl`.
+"""
+import datetime
+import json
+import logging
+import logging.handlers
+import threading
+
+FIELDS = ('ts', 'run', 'sheet', 'operation', 'outcome', 'row', 'event_id',
+          'user', 'uid', 'duration_ms', 'error')
+
+
+class RunLog:
+    """JSON-lines writer for one run. Without a path, records are dropped."""
+
+    def __init__(self, path, run_id, sheet=None, buffer_size=500):
+        self.run_id = run_id
+        self.sheet = sheet
+        self._handler = self._target = None
+        if path:
+            # RotatingFileHandler isn't safe with several processes appending
+            self._target = logging.handlers.WatchedFileHandler(path, encoding='utf-8', delay=True)
+            self._handler = logging.handlers.MemoryHandler(
+                buffer_size, flushLevel=logging.ERROR, target=self._target)
+        self._lock = threading.Lock()
+
+    def record(self, operation, outcome, row=None, event_id=None, user=None, uid=None,
+               duration=None, error=None):
+        """Logs one operation; duration is in seconds, outcome e.g. 'ok', 'error', 'created'."""
+        if self._handler is None:
+            return
+        values = {
+            'ts': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='milliseconds'),
+            'run': self.run_id,
+            'sheet': self.sheet,
+            'operation': operation,
+            'outcome': outcome,
+            'row': row,
+            'event_id': event_id,
+            'user': user,
+            'uid': uid,
+            'duration_ms': round(duration * 1000, 3) if duration is not None else None,
+            'error': str(error) if error is not None else None,
+        }
+        # Same keys in the same order on every line
+        entry = {field: values[field] for field in FIELDS}
+        level = logging.ERROR if outcome == 'error' else logging.INFO
+        with self._lock:
+            self._handler.handle(logging.makeLogRecord({
+                'msg': json.dumps(entry, default=str), 'levelno': level,
+                'levelname': logging.getLevelName(level)}))
+
+    def close(self):
+        if self._handler is not None:
+            # Flushes the buffer; the file handler has to be closed separately
+            self._handler.close()
+            self._target.close()
+            self._handler = self._target = None
@@ -1,18 +1,126 @@
 import os
 import pickle
 import datetime
+import functools
+import logging
+import threading
+import time
 import uuid  # For generating UIDs for new events
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote, urlparse
 
 from google_auth_oauthlib.flow import InstalledAppFlow
 from google.auth.transport.requests import Request
 from googleapiclient.discovery import build
 
 import caldav
+import icalendar
+from caldav.lib.url import URL
+from django.conf import settings
+from django.utils import timezone
 from ics import Calendar, Event
 
+from .metrics import metrics, PHASE_CALDAV, PHASE_CALDAV_REQUEST, PHASE_SHEETS_FETCH
+from .profiling import profiler
+
+# Errors are raised on to the caller, which reports them; this is for debugging
+logger = logging.getLogger(__name__)
+
+
+def build_ics_event(sheet_event, uid):
+    """Builds the iCalendar VEVENT for a SheetEvent."""
+    e = Event()
+    e.name = sheet_event.title
+    e.description = sheet_event.description
+    e.begin = sheet_event.start_time
+    e.end = sheet_event.end_time
+    e.uid = uid
+    # Serialized as DTSTAMP, required by RFC 5545
+    e.created = timezone.now()
+    return e
+
+
+def build_series_calendar(series, occurrences, uid):
+    """
+    Builds the iCalendar document of an EventSeries: a master VEVENT with
+    RRULE and EXDATEs, plus a RECURRENCE-ID override for every occurrence
+    whose description differs from the series.
+    The `ics` library can't write recurrences, so this uses `icalendar`.
+    """
+    local_tz = timezone.get_current_timezone()
+    start = series.start_time.astimezone(local_tz)
+    duration = series.end_time - series.start_time
+
+    cal = icalendar.Calendar()
+    cal.add('prodid', '-//cal_sync//Sheet event series//EN')
+    cal.add('version', '2.0')
+
+    master = icalendar.Event()
+    master.add('uid', uid)
+    master.add('dtstamp', timezone.now())
+    master.add('summary', series.title)
+    master.add('description', series.description)
+    master.add('dtstart', start)
+    master.add('dtend', start + duration)
+    if series.interval_days % 7 == 0:
+        rrule = {'freq': 'weekly', 'interval': series.interval_days // 7, 'count': series.count}
+    else:
+        rrule = {'freq': 'daily', 'interval': series.interval_days, 'count': series.count}
+    master.add('rrule', rrule)
+    if series.exdates:
+        master.add('exdate', [datetime.datetime.fromisoformat(exdate).astimezone(local_tz)
+                              for exdate in series.exdates])
+    cal.add_component(master)
+
+    for occurrence in occurrences:
+        if occurrence.description == series.description:
+            continue
+        occurrence_start = occurrence.start_time.astimezone(local_tz)
+        override = icalendar.Event()
+        override.add('uid', uid)
+        override.add('dtstamp', timezone.now())
+        override.add('recurrence-id', occurrence_start)
+        override.add('summary', occurrence.title)
+        override.add('description', occurrence.description)
+        override.add('dtstart', occurrence_start)
+        override.add('dtend', occurrence.end_time.astimezone(local_tz))
+        cal.add_component(override)
+
+    # Clients need the VTIMEZONE to expand the rule across DST changes,
+    # limited to the transitions within the series
+    last_start = start + datetime.timedelta(days=series.interval_days * (series.count - 1))
+    cal.add_missing_timezones(first_date=start.date(),
+                              last_date=last_start.date() + datetime.timedelta(days=1))
+    return cal.to_ical().decode('utf-8')
+
+
+def iter_ics_feed(sheet_events):
+    """
+    Yields an iCalendar document for the given SheetEvents in chunks,
+    one VEVENT at a time, so large feeds never have to be built in memory.
+    UIDs are derived from the SheetEvent PK to stay stable between requests.
+    """
+    yield 'BEGIN:VCALENDAR\r\nVERSION:2.0\r\nPRODID:-//cal_sync//Sheet events feed//EN\r\n'
+    for sheet_event in sheet_events:
+        e = build_ics_event(
+            sheet_event, f"django-sheet-event-{sheet_event.pk}")
+        yield e.serialize() + '\r\n'
+    yield 'END:VCALENDAR\r\n'
+
+
+def new_sheet_event_uid(sheet_event):
+    # The PK keeps it recognisable, the UUID makes it globally unique
+    return f"django-sheet-event-{sheet_event.pk}-{uuid.uuid4()}"
+
+
+def new_series_uid(series):
+    return f"django-event-series-{series.pk}-{uuid.uuid4()}"
+
 
 class GoogleSheetsService:
     SCOPES = ['https://www.googleapis.com/auth/spreadsheets.readonly']
+    API_NAME = 'sheets'
+    API_VERSION = 'v4'
 
     def __init__(self, credentials_file='credentials.json', token_file='token.pickle'):
         self.credentials_file = credentials_file
@@ -42,38 +150,118 @@ class GoogleSheetsService:
             # Save the credentials for the next run
             with open(self.token_file, 'wb') as token:
                 pickle.dump(creds, token)
-        return build('sheets', 'v4', credentials=creds)
+        return build(self.API_NAME, self.API_VERSION, credentials=creds)
 
     def get_sheet_data(self, spreadsheet_id, range_name):
         """
         Fetches data from a specified Google Sheet.
         """
         try:
-            result = self.service.spreadsheets().values().get(
-                spreadsheetId=spreadsheet_id, range=range_name).execute()
+            start = time.perf_counter()
+            with metrics.span(PHASE_SHEETS_FETCH):
+                result = self.service.spreadsheets().values().get(
+                    spreadsheetId=spreadsheet_id, range=range_name).execute()
+            profiler.record_http(time.perf_counter() - start)
             values = result.get('values', [])
             return values
         except Exception as e:
-            print(f"Error fetching Google Sheet data: {e}")
+            logger.debug('Error fetching Google Sheet data: %s', e)
             raise
 
 
+class GoogleDriveService(GoogleSheetsService):
+    """
+    Registers Drive push notification channels for spreadsheets, so changes
+    can trigger a sync instead of waiting for the next poll.
+    Needs a separate token, as it asks for a Drive scope.
+    """
+    SCOPES = ['https://www.googleapis.com/auth/drive.metadata.readonly']
+    API_NAME = 'drive'
+    API_VERSION = 'v3'
+
+    def __init__(self, credentials_file='credentials.json', token_file='token_drive.pickle'):
+        super().__init__(credentials_file, token_file)
+
+    def watch_file(self, file_id, channel_id, channel_token, address, expiration):
+        """
+        Opens a notification channel posting changes of the file to address.
+        Returns the resource ID and the expiration Drive granted.
+        """
+        result = self.service.files().watch(fileId=file_id, body={
+            'id': channel_id,
+            'type': 'web_hook',
+            'address': address,
+            'token': channel_token,
+            'expiration': int(expiration.timestamp() * 1000),
+        }).execute()
+        granted = datetime.datetime.fromtimestamp(
+            int(result['expiration']) / 1000, tz=datetime.timezone.utc)
+        return result['resourceId'], granted
+
+    def stop_channel(self, channel_id, resource_id):
+        self.service.channels().stop(
+            body={'id': channel_id, 'resourceId': resource_id}).execute()
+
+
+class InstrumentedDAVClient(caldav.DAVClient):
+    """DAVClient recording the latency of every HTTP request it sends."""
+
+    def request(self, url, method="GET", *args, **kwargs):
+        host = urlparse(str(url)).hostname or urlparse(str(self.url)).hostname
+        start = time.perf_counter()
+        try:
+            with metrics.span(PHASE_CALDAV_REQUEST, host=host, method=method):
+                return super().request(url, method, *args, **kwargs)
+        finally:
+            profiler.record_http(time.perf_counter() - start)
+
+
+class BatchResult:
+    """Outcome of one item of a CalDAVService batch, error is None on success."""
+
+    def __init__(self, uid, error=None, duration=None):
+        self.uid = uid
+        self.error = error
+        # Seconds the request took
+        self.duration = duration
+
+    @property
+    def ok(self):
+        return self.error is None
+
+
+def caldav_operation(func):
+    """Records a CalDAVService method as one operation of the caldav phase."""
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        with metrics.span(PHASE_CALDAV, host=self.host, operation=func.__name__):
+            return func(self, *args, **kwargs)
+    return wrapper
+
+
 class CalDAVService:
-    def __init__(self, caldav_url, username, password):
+    def __init__(self, caldav_url, username, password, calendar_url=None):
         self.caldav_url = caldav_url
         self.username = username
         self.password = password
+        # Known calendar URL, skips the principal/calendar discovery
+        self.calendar_url = calendar_url
+        self.host = urlparse(caldav_url).hostname
         self._client = None
         self._principal = None
         self._calendar = None  # actual caldav.Calendar object
+        self._capabilities = None
+
+    def _new_client(self):
+        return InstrumentedDAVClient(
+            url=self.caldav_url,
+            username=self.username,
+            password=self.password
+        )
 
     def _get_client(self):
         if not self._client:
-            self._client = caldav.DAVClient(
-                url=self.caldav_url,
-                username=self.username,
-                password=self.password
-            )
+            self._client = self._new_client()
         return self._client
 
     def _get_principal(self):
@@ -92,6 +280,8 @@ class CalDAVService:
         Connects to CalDAV server and returns the primary calendar.
         In a real app, you might offer the user a choice if they have multiple.
         """
+        if not self._calendar and self.calendar_url:
+            self._calendar = self._get_client().calendar(url=self.calendar_url)
         if not self._calendar:
             principal = self._get_principal()
             calendars = principal.calendars()
@@ -102,6 +292,20 @@ class CalDAVService:
             self._calendar = calendars[0]
         return self._calendar
 
+    @caldav_operation
+    def list_calendars(self):
+        """
+        Discovers the calendars of the principal.
+        Returns a list of {'url': ..., 'name': ...} dicts, the first one being
+        the calendar get_or_select_calendar() would pick.
+        """
+        calendars = self._get_principal().calendars()
+        if not calendars:
+            raise Exception(
+                "No CalDAV calendars found for this user with the provided URL and credentials.")
+        return [{'url': str(calendar.url), 'name': calendar.name or ''} for calendar in calendars]
+
+    @caldav_operation
     def find_event_by_uid(self, uid):
         """Finds an event by its UID within the selected calendar."""
         calendar = self.get_or_select_calendar()
@@ -111,22 +315,19 @@ class CalDAVService:
         except caldav.lib.error.NotFoundError:
             return None  # Event not found, which is expected for new events
         except Exception as e:
-            print(f"Error finding CalDAV event by UID {uid}: {e}")
+            logger.debug('Error finding CalDAV event by UID %s: %s', uid, e)
             raise
 
-    def create_event(self, sheet_event):
-        """Creates a new event in the CalDAV calendar."""
+    @caldav_operation
+    def create_event(self, sheet_event, uid=None):
+        """
+        Creates a new event in the CalDAV calendar. The resource is named
+        after the UID, so creating with a UID that exists replaces that event.
+        """
         calendar = self.get_or_select_calendar()
 
         c = Calendar()
-        e = Event()
-        e.name = sheet_event.title
-        e.description = sheet_event.description
-        e.begin = sheet_event.start_time
-        e.end = sheet_event.end_time
-        # Generate a UID for the event. Using sheet_event's PK ensures uniqueness
-        # and stability for updates. Appending a UUID makes it globally unique.
-        e.uid = f"django-sheet-event-{sheet_event.pk}-{uuid.uuid4()}"
+        e = build_ics_event(sheet_event, uid or new_sheet_event_uid(sheet_event))
 
         c.events.add(e)
 
@@ -136,19 +337,20 @@ class CalDAVService:
             # print(f"CalDAV event '{sheet_event.title}' created with UID: {e.uid}")
             return e.uid  # Return the UID we assigned for tracking
         except Exception as ex:
-            print(f"Error creating CalDAV event '{sheet_event.title}': {ex}")
+            logger.debug("Error creating CalDAV event '%s': %s", sheet_event.title, ex)
             raise
 
+    @caldav_operation
     def update_event(self, caldav_uid, sheet_event):
         """Updates an existing event in the CalDAV calendar."""
         calendar = self.get_or_select_calendar()
         existing_event_resource = self.find_event_by_uid(caldav_uid)
 
         if not existing_event_resource:
-            print(
-                f"Warning: CalDAV event with UID {caldav_uid} not found for update. Creating new event for '{sheet_event.title}'.")
-            # Fallback to create if not found
-            return self.create_event(sheet_event)
+            logger.info("CalDAV event with UID %s not found for update. Creating new event for '%s'.",
+                        caldav_uid, sheet_event.title)
+            # Fallback to create if not found, keeping the UID the caller tracks
+            return self.create_event(sheet_event, caldav_uid)
 
         # Parse the existing iCalendar data
         existing_cal = Calendar(existing_event_resource.data)
@@ -173,10 +375,199 @@ class CalDAVService:
             # print(f"CalDAV event '{sheet_event.title}' (UID: {caldav_uid}) updated.")
             return caldav_uid  # Return the same UID
         except Exception as ex:
-            print(
-                f"Error updating CalDAV event '{sheet_event.title}' (UID: {caldav_uid}): {ex}")
+            logger.debug("Error updating CalDAV event '%s' (UID: %s): %s", sheet_event.title, caldav_uid, ex)
+            raise
+
+    @caldav_operation
+    def create_series(self, series, occurrences, uid=None):
+        """Creates an EventSeries as one recurring event, returns its UID."""
+        calendar = self.get_or_select_calendar()
+        uid = uid or new_series_uid(series)
+        try:
+            calendar.add_event(build_series_calendar(series, occurrences, uid))
+            return uid
+        except Exception as ex:
+            logger.debug("Error creating CalDAV series '%s': %s", series.title, ex)
             raise
 
+    @caldav_operation
+    def update_series(self, caldav_uid, series, occurrences):
+        """Rewrites the recurring event of an EventSeries, including its overrides."""
+        existing_event_resource = self.find_event_by_uid(caldav_uid)
+        if not existing_event_resource:
+            logger.info("CalDAV series with UID %s not found for update. Creating new event for '%s'.",
+                        caldav_uid, series.title)
+            return self.create_series(series, occurrences, caldav_uid)
+
+        try:
+            existing_event_resource.data = build_series_calendar(
+                series, occurrences, caldav_uid)
+            existing_event_resource.save()
+            return caldav_uid
+        except Exception as ex:
+            logger.debug("Error updating CalDAV series '%s' (UID: %s): %s", series.title, caldav_uid, ex)
+            raise
+
+    def batch_capabilities(self):
+        """
+        Asks the calendar collection what it supports (OPTIONS), once per service.
+        Returns the DAV compliance classes and allowed methods as sets of
+        strings, both empty if the server doesn't answer OPTIONS.
+        """
+        if self._capabilities is None:
+            calendar_url = str(self.get_or_select_calendar().url)
+            try:
+                headers = self._get_client().options(calendar_url).headers
+            except Exception:
+                headers = {}
+            self._capabilities = {
+                'dav': {token.strip() for token in headers.get('DAV', '').split(',') if token.strip()},
+                'allow': {method.strip().upper() for method in headers.get('Allow', '').split(',')
+                          if method.strip()},
+            }
+        return self._capabilities
+
+    def _batch_workers(self, items):
+        """
+        Concurrent keep-alive connections for a batch. Servers that don't
+        advertise calendar-access with PUT and DELETE get one request at a time.
+        """
+        capabilities = self.batch_capabilities()
+        if 'calendar-access' not in capabilities['dav'] or \
+                not {'PUT', 'DELETE'} <= capabilities['allow']:
+            return 1
+        return max(1, min(getattr(settings, 'CALDAV_BATCH_WORKERS', 4), len(items)))
+
+    def _run_batch(self, func, items):
+        """
+        Calls func(client, item) for every item on a pool of workers, each
+        with its own keep-alive connection. Returns the results in item order.
+        """
+        if not items:
+            return []
+        workers = self._batch_workers(items)
+        if workers == 1:
+            client = self._get_client()
+            return [func(client, item) for item in items]
+
+        local = threading.local()
+        clients = []
+        lock = threading.Lock()
+        # The requests count towards the caller's profiling units
+        units = profiler.open_units()
+
+        def run(item):
+            if not hasattr(local, 'client'):
+                local.client = self._new_client()
+                with lock:
+                    clients.append(local.client)
+            with profiler.attach(units):
+                return func(local.client, item)
+
+        try:
+            with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='caldav-batch') as pool:
+                return list(pool.map(run, items))
+        finally:
+            for client in clients:
+                client.close()
+
+    def _resource_url(self, calendar_url, uid):
+        # Same resource name the caldav library derives from the UID on creation
+        return str(URL.objectify(calendar_url).join(quote(uid.replace('/', '%2F')) + '.ics'))
+
+    @caldav_operation
+    def put_events(self, items):
+        """
+        Writes many events to the calendar, creating or replacing them by UID.
+        `items` are (uid, sheet_event) pairs. Unlike update_event, nothing is
+        read first; the event is replaced as a whole. Events the server keeps
+        under another resource name, e.g. written by an older client, refuse
+        the write with a UID conflict and are looked up by UID.
+        Returns a BatchResult per item, in order; failures don't stop the batch.
+        """
+        calendar_url = str(self.get_or_select_calendar().url)
+        headers = {'Content-Type': 'text/calendar; charset=utf-8'}
+        conflicts = {}
+
+        def ics(uid, sheet_event):
+            c = Calendar()
+            c.events.add(build_ics_event(sheet_event, uid))
+            return str(c)
+
+        def put(client, item):
+            uid, sheet_event = item
+            start = time.perf_counter()
+            try:
+                response = client.put(self._resource_url(calendar_url, uid), ics(uid, sheet_event), headers)
+                if response.status in (403, 409, 412):
+                    conflicts[uid] = sheet_event
+                if response.status >= 300:
+                    raise Exception(f"PUT returned HTTP {response.status}")
+                return BatchResult(uid, duration=time.perf_counter() - start)
+            except Exception as e:
+                return BatchResult(uid, error=e, duration=time.perf_counter() - start)
+
+        results = self._run_batch(put, items)
+        # Rare, searched one at a time on the service's own connection
+        for i, result in enumerate(results):
+            if result.uid not in conflicts:
+                continue
+            start = time.perf_counter()
+            try:
+                resource = self.find_event_by_uid(result.uid)
+                if resource is None:
+                    continue
+                response = self._get_client().put(
+                    str(resource.url), ics(result.uid, conflicts[result.uid]), headers)
+                if response.status >= 300:
+                    raise Exception(f"PUT returned HTTP {response.status}")
+                results[i] = BatchResult(result.uid, duration=result.duration + time.perf_counter() - start)
+            except Exception as e:
+                results[i] = BatchResult(result.uid, error=e,
+                                         duration=result.duration + time.perf_counter() - start)
+        return results
+
+    @caldav_operation
+    def delete_events(self, caldav_uids):
+        """
+        Deletes many events from the calendar by UID. Events not found under
+        the resource name derived from the UID, e.g. written by an older
+        client, are looked up by UID; events already gone count as deleted.
+        Returns a BatchResult per UID, in order.
+        """
+        calendar_url = str(self.get_or_select_calendar().url)
+        not_found = set()
+
+        def delete(client, uid):
+            start = time.perf_counter()
+            try:
+                response = client.delete(self._resource_url(calendar_url, uid))
+                if response.status == 404:
+                    not_found.add(uid)
+                elif response.status >= 300:
+                    raise Exception(f"DELETE returned HTTP {response.status}")
+                return BatchResult(uid, duration=time.perf_counter() - start)
+            except Exception as e:
+                return BatchResult(uid, error=e, duration=time.perf_counter() - start)
+
+        results = self._run_batch(delete, list(caldav_uids))
+        # Rare, searched one at a time on the service's own connection
+        for i, result in enumerate(results):
+            if result.uid not in not_found:
+                continue
+            start = time.perf_counter()
+            try:
+                resource = self.find_event_by_uid(result.uid)
+                if resource is not None:
+                    resource.delete()
+            except Exception as e:
+                results[i] = BatchResult(result.uid, error=e,
+                                         duration=result.duration + time.perf_counter() - start)
+            else:
+                result.duration += time.perf_counter() - start
+        return results
+
+    @caldav_operation
     def delete_event(self, caldav_uid):
         """Deletes an event from the CalDAV calendar."""
         calendar = self.get_or_select_calendar()
@@ -188,10 +579,8 @@ class CalDAVService:
                 # print(f"CalDAV event with UID {caldav_uid} deleted.")
                 return True
             except Exception as ex:
-                print(
-                    f"Error deleting CalDAV event with UID {caldav_uid}: {ex}")
+                logger.debug('Error deleting CalDAV event with UID %s: %s', caldav_uid, ex)
                 raise
         else:
-            print(
-                f"CalDAV event with UID {caldav_uid} not found for deletion (already gone?).")
+            logger.info('CalDAV event with UID %s not found for deletion (already gone?).', caldav_uid)
             return False
@@ -0,0 +1,204 @@
+import datetime
+import io
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.management import call_command
+from django.db import close_old_connections, transaction
+from django.utils import timezone
+
+from .management.commands.poll_sheet import Command as PollSheetCommand
+from .models import CalendarConfig, SheetEvent, SheetSource, UserCalDAVEvent, UserCalDAVSeries, UserEventBinding
+from .models import UserProfile
+from .services import CalDAVService
+
+logger = logging.getLogger(__name__)
+
+# CalDAV discovery can take several seconds, it must not run in a web worker
+_executor = ThreadPoolExecutor(
+    max_workers=getattr(settings, 'CALDAV_VALIDATION_WORKERS', 2),
+    thread_name_prefix='caldav-validation')
+# Admin actions and purges may take minutes, connection checks don't wait for them
+_sync_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='caldav-sync')
+
+
+def enqueue_calendar_validation(config_id):
+    """Checks the CalendarConfig in the background once the current transaction commits."""
+    transaction.on_commit(
+        lambda: _executor.submit(_run_in_thread, validate_calendar_config, config_id))
+
+
+def enqueue_calendar_purge(user_profile_id):
+    """Removes the user's pushed events from CalDAV in the background once the current transaction commits."""
+    transaction.on_commit(
+        lambda: _sync_executor.submit(_run_in_thread, purge_user_calendar, user_profile_id))
+
+
+def _run_in_thread(func, *args):
+    # Threads get their own DB connection, don't leak it
+    close_old_connections()
+    try:
+        return func(*args)
+    except Exception:
+        logger.exception('Background task %s failed', func.__name__)
+    finally:
+        close_old_connections()
+
+
+def validate_calendar_config(config_id):
+    """
+    Connects to the CalDAV server of a CalendarConfig and records the outcome
+    on it, together with the discovered calendars.
+    Returns the new validation status.
+    """
+    config = CalendarConfig.objects.get(pk=config_id)
+    # Only the credentials that were checked may receive the result, the
+    # user could have saved different ones in the meantime.
+    checked = CalendarConfig.objects.filter(
+        pk=config.pk,
+        caldav_url=config.caldav_url,
+        caldav_username=config.caldav_username,
+        caldav_password=config.caldav_password,
+    )
+    checked.update(validation_status=CalendarConfig.VALIDATION_RUNNING)
+
+    try:
+        caldav_service = CalDAVService(
+            config.caldav_url,
+            config.caldav_username,
+            config.caldav_password
+        )
+        calendars = caldav_service.list_calendars()
+    except Exception as e:
+        checked.update(
+            validation_status=CalendarConfig.VALIDATION_FAILED,
+            validation_error=str(e),
+            validated_at=timezone.now(),
+        )
+        # The dashboard shows the status
+        UserProfile.objects.filter(pk=config.user_profile_id).bump_events_version()
+        return CalendarConfig.VALIDATION_FAILED
+
+    known_urls = [calendar['url'] for calendar in calendars]
+    # Keep the user's calendar if it still exists, otherwise use the first one
+    calendar_url = config.calendar_url if config.calendar_url in known_urls else known_urls[0]
+    checked.update(
+        validation_status=CalendarConfig.VALIDATION_OK,
+        validation_error='',
+        validated_at=timezone.now(),
+        discovered_calendars=calendars,
+        calendar_url=calendar_url,
+    )
+    UserProfile.objects.filter(pk=config.user_profile_id).bump_events_version()
+    return CalendarConfig.VALIDATION_OK
+
+
+def _notification_debounce():
+    return datetime.timedelta(seconds=getattr(settings, 'SHEET_NOTIFICATION_DEBOUNCE_SECONDS', 30))
+
+
+def sync_due_sources(sheets_service=None):
+    """
+    Runs an incremental poll_sheet for every SheetSource with a pending
+    notification older than the debounce delay. Called by the
+    sync_sheet_sources command, never in the web process: a poll resets the
+    process wide metrics and would hold up the connection checks.
+    Returns the spreadsheet IDs that were synced.
+    """
+    quiet_since = timezone.now() - _notification_debounce()
+    due = SheetSource.objects.filter(
+        sync_requested_at__isnull=False, last_notified_at__lte=quiet_since)
+    synced = []
+    for source in due:
+        call_command('poll_sheet', spreadsheet_id=source.spreadsheet_id,
+                     range_name=source.range_name, incremental=True,
+                     sheets_service=sheets_service, stdout=io.StringIO())
+        synced.append(source.spreadsheet_id)
+    return synced
+
+
+def enqueue_admin_action(func, ids):
+    """Runs an admin bulk action on the selected PKs in the background once the current transaction commits."""
+    ids = list(ids)
+    transaction.on_commit(lambda: _sync_executor.submit(_run_in_thread, func, ids))
+
+
+def _admin_sync_command():
+    # The batched sync of poll_sheet, without a sheet lease or run log
+    return PollSheetCommand(stdout=io.StringIO())
+
+
+def resync_sheet_events(sheet_event_ids):
+    """
+    Writes the SheetEvents to the calendars of their users again, one batch
+    per user. Occurrences of a collapsed series are written with their
+    series by poll_sheet and skipped here.
+    Returns the poll_sheet summary counters.
+    """
+    command = _admin_sync_command()
+    sheet_events = list(SheetEvent.objects.filter(pk__in=sheet_event_ids, series__isnull=True))
+    command._sync_sheet_events_to_users_calendars(sheet_events)
+    return command.summary
+
+
+def purge_sheet_events(sheet_event_ids):
+    """
+    Deletes the SheetEvents from the calendars of their users and from the
+    database. Events whose CalDAV deletion failed are kept, so the purge can
+    be repeated. Rows still in the sheet come back with the next poll.
+    Returns the poll_sheet summary counters.
+    """
+    command = _admin_sync_command()
+    sheet_events = SheetEvent.objects.filter(pk__in=sheet_event_ids, series__isnull=True)
+    command._delete_sheet_events_from_users_calendars(sheet_events)
+    deletable = sheet_events.filter(usercaldavevent__isnull=True)
+    # Feeds and dashboards of the assigned users change, as in poll_sheet
+    person_names = {name for sheet_event in deletable for name in sheet_event.person_names()}
+    person_names.update(name.strip() for name in list(person_names))
+    _, deleted = deletable.delete()
+    command.summary['events_deleted'] += deleted.get(SheetEvent._meta.label, 0)
+    if person_names:
+        affected_profile_ids = UserEventBinding.objects.filter(
+            sheet_name__in=person_names).values_list('user_profile_id', flat=True)
+        UserProfile.objects.filter(pk__in=list(affected_profile_ids)).bump_events_version()
+    return command.summary
+
+
+def resync_user_caldav_events(user_caldav_event_ids):
+    """
+    Writes the events of the UserCalDAVEvents to their users' calendars
+    again, leaving the other users of the same events alone. Mappings of
+    series occurrences are skipped, as in resync_sheet_events.
+    Returns the poll_sheet summary counters.
+    """
+    command = _admin_sync_command()
+    pairs = set(UserCalDAVEvent.objects.filter(
+        pk__in=user_caldav_event_ids, sheet_event__series__isnull=True).values_list(
+            'user_profile_id', 'sheet_event_id'))
+    sheet_events = list(SheetEvent.objects.filter(pk__in={sheet_event_id for _, sheet_event_id in pairs}))
+    command._sync_sheet_events_to_users_calendars(sheet_events, pairs)
+    return command.summary
+
+
+def purge_user_caldav_events(user_caldav_event_ids):
+    """
+    Deletes the UserCalDAVEvents from CalDAV and the database; the next poll
+    writes the events again if they are still in the sheet.
+    Returns the poll_sheet summary counters.
+    """
+    command = _admin_sync_command()
+    command._delete_user_caldav_events(UserCalDAVEvent.objects.filter(pk__in=user_caldav_event_ids))
+    return command.summary
+
+
+def purge_user_calendar(user_profile_id):
+    """
+    Deletes every event and series poll_sheet wrote to the user's calendar,
+    e.g. after push was turned off in favour of the iCalendar feed.
+    Returns the poll_sheet summary counters.
+    """
+    command = _admin_sync_command()
+    command._delete_user_caldav_events(UserCalDAVEvent.objects.filter(user_profile_id=user_profile_id))
+    command._delete_user_caldav_series(UserCalDAVSeries.objects.filter(user_profile_id=user_profile_id))
+    return command.summary
@@ -1,3 +1,804 @@
-from django.test import TestCase
+import datetime
+import io
+import json
+import os
+import tempfile
+import threading
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection
+from django.test import Client, TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from .benchmarks.fake_caldav import FakeCalDAVServer
+from .benchmarks.synthetic import DATE_FORMAT, HEADERS, SyntheticSheetsService, generate_sheet
+from .management.commands.poll_sheet import Command as PollSheetCommand
+from .metrics import MetricsRecorder, render_prometheus
+from .models import UserProfile, SheetEvent, UserEventBinding, CalendarConfig, UserCalDAVEvent, SheetSource
+from .models import EventSeries, UserCalDAVSeries
+from .profiling import QueryBudgetMixin, profiler
+from .recurrence import detect_series
+from .runlog import FIELDS as RUN_LOG_FIELDS
+from .services import CalDAVService
+from .tasks import (purge_sheet_events, purge_user_caldav_events, purge_user_calendar, resync_sheet_events,
+                    resync_user_caldav_events, sync_due_sources, validate_calendar_config)
+
+
+def create_user(username, sheet_name=None, caldav_server=None):
+    user = User.objects.create_user(username, password='secret')
+    user_profile = UserProfile.objects.create(user=user)
+    if sheet_name:
+        UserEventBinding.objects.create(user_profile=user_profile, sheet_name=sheet_name)
+    if caldav_server:
+        CalendarConfig.objects.create(
+            user_profile=user_profile,
+            caldav_url=caldav_server.user_url(username),
+            caldav_username=username,
+            caldav_password='secret',
+            validation_status=CalendarConfig.VALIDATION_OK,
+            calendar_url=caldav_server.calendar_url(username),
+        )
+    return user
+
+
+def create_sheet_event(event_id, *person_names, days=1):
+    start_time = timezone.now() + datetime.timedelta(days=days)
+    names = list(person_names) + [None] * (4 - len(person_names))
+    return SheetEvent.objects.create(
+        event_id_in_sheet=event_id, title=f'Event {event_id}',
+        start_time=start_time, end_time=start_time + datetime.timedelta(hours=2),
+        person1_name=names[0], person2_name=names[1],
+        person3_name=names[2], person4_name=names[3])
+
+
+class ViewQueryBudgetTests(QueryBudgetMixin, TestCase):
+    def setUp(self):
+        self.user = create_user('alice', sheet_name='Alice')
+        for i in range(30):
+            create_sheet_event(f'evt-{i}', 'Alice', 'Bob', days=i)
+        self.client.force_login(self.user)
+
+    def test_dashboard(self):
+        # session, user, profile with config, binding, event count and page, feed token
+        with self.assertQueryBudget(7):
+            response = self.client.get(reverse('dashboard'))
+        self.assertEqual(response.status_code, 200)
+        # Cached until the events version changes
+        with self.assertQueryBudget(4):
+            self.client.get(reverse('dashboard'))
+
+    def test_dashboard_not_modified(self):
+        # The first response sets the CSRF cookie, which is part of the ETag
+        self.client.get(reverse('dashboard'))
+        response = self.client.get(reverse('dashboard'))
+        with self.assertQueryBudget(3):
+            response = self.client.get(reverse('dashboard'), HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+    @override_settings(SYNC_PROFILING=True)
+    def test_profiling_survives_a_profiled_run(self):
+        self.addCleanup(setattr, profiler, 'always_on', False)
+        self.assertIn('Server-Timing', self.client.get(reverse('dashboard')))
+        # e.g. poll_sheet --profile in the web process
+        profiler.start()
+        profiler.stop()
+        response = self.client.get(reverse('dashboard'))
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('Server-Timing', response)
+
+    def test_configure_binding(self):
+        with self.assertQueryBudget(4):
+            self.client.get(reverse('configure_binding'))
+        with self.assertQueryBudget(12):
+            response = self.client.post(reverse('configure_binding'), {'sheet_name': 'Alice B.'})
+        self.assertRedirects(response, reverse('dashboard'), fetch_redirect_response=False)
+
+
+@override_settings(DASHBOARD_WINDOW_DAYS=30, DASHBOARD_EVENTS_PER_PAGE=25)
+class DashboardTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = create_user('alice', sheet_name='Alice')
+        for i in range(40):
+            create_sheet_event(f'evt-{i}', 'Alice', days=i)
+        create_sheet_event('evt-bob', 'Bob')
+        self.client.force_login(self.user)
+        # Sets the CSRF cookie, which is part of the ETag
+        self.client.get(reverse('dashboard'))
+
+    def get(self, **params):
+        response = self.client.get(reverse('dashboard'), params)
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def test_window(self):
+        self.assertEqual(self.get().context['events_page']['count'], 30)
+        self.assertEqual(self.get(window='10').context['events_page']['count'], 10)
+        self.assertEqual(self.get(window='all').context['events_page']['count'], 40)
+        # Invalid windows fall back to the default, huge ones are cut
+        self.assertEqual(self.get(window='-5').context['events_page']['count'], 30)
+        response = self.get(window='99999999999')
+        self.assertEqual(response.context['window_days'], 3650)
+        self.assertEqual(response.context['events_page']['count'], 40)
+        self.assertEqual(response['ETag'], self.get(window='3650')['ETag'])
+
+    def test_login_invalidates_cached_page(self):
+        # The page holds a CSRF token, logging in again rotates it
+        client = Client()
+        client.post(reverse('login'), {'username': 'alice', 'password': 'secret'})
+        etag = client.get(reverse('dashboard'))['ETag']
+        self.assertEqual(client.get(reverse('dashboard'), HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        client.post(reverse('login'), {'username': 'alice', 'password': 'secret'})
+        response = client.get(reverse('dashboard'), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+    def test_pagination(self):
+        first_page = self.get(window='all')
+        self.assertEqual(first_page.context['events_page']['num_pages'], 2)
+        self.assertEqual(len(first_page.context['assigned_events']), 25)
+        second_page = self.get(window='all', page='2')
+        self.assertEqual(second_page.context['events_page']['number'], 2)
+        self.assertEqual(len(second_page.context['assigned_events']), 15)
+        self.assertNotEqual(first_page['ETag'], second_page['ETag'])
+        # Invalid pages show the first one
+        self.assertEqual(self.get(window='all', page='x')['ETag'], first_page['ETag'])
+        # Pages past the end show the last one
+        self.assertEqual(self.get(window='all', page='9').context['events_page']['number'], 2)
+
+
+class CalDAVConfigTests(TestCase):
+    def setUp(self):
+        self.caldav_server = FakeCalDAVServer().start()
+        self.addCleanup(self.caldav_server.stop)
+        self.user = create_user('alice', sheet_name='Alice', caldav_server=self.caldav_server)
+        self.config = CalendarConfig.objects.get(user_profile__user=self.user)
+        self.client.force_login(self.user)
+
+    def status(self):
+        response = self.client.get(reverse('caldav_status'))
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_status(self):
+        self.assertEqual(self.status()['status'], CalendarConfig.VALIDATION_OK)
+        self.config.delete()
+        self.assertEqual(self.status(), {'status': None})
+
+    def test_validation_updates_status_and_dashboard(self):
+        CalendarConfig.objects.filter(pk=self.config.pk).update(
+            validation_status=CalendarConfig.VALIDATION_PENDING, calendar_url='')
+        etag = self.client.get(reverse('dashboard'))['ETag']
+        self.assertEqual(validate_calendar_config(self.config.pk), CalendarConfig.VALIDATION_OK)
+        status = self.status()
+        self.assertEqual(status['status'], CalendarConfig.VALIDATION_OK)
+        self.assertEqual([calendar['url'] for calendar in status['calendars']],
+                         [self.caldav_server.calendar_url('alice')])
+        response = self.client.get(reverse('dashboard'), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+    def test_result_of_outdated_credentials_is_dropped(self):
+        def change_password():
+            # The user saves other credentials while the check runs
+            CalendarConfig.objects.filter(pk=self.config.pk).update(
+                caldav_password='changed', validation_status=CalendarConfig.VALIDATION_PENDING)
+            return [{'url': self.caldav_server.calendar_url('alice'), 'name': 'Calendar'}]
+
+        with mock.patch('core.tasks.CalDAVService') as caldav_service:
+            caldav_service.return_value.list_calendars.side_effect = change_password
+            validate_calendar_config(self.config.pk)
+        self.config.refresh_from_db()
+        self.assertEqual(self.config.validation_status, CalendarConfig.VALIDATION_PENDING)
+
+    def test_turning_push_off_purges_the_calendar(self):
+        data = {'caldav_url': self.config.caldav_url, 'caldav_username': 'alice',
+                'caldav_password': 'secret', 'push_enabled': ''}
+        with self.captureOnCommitCallbacks() as callbacks:
+            self.client.post(reverse('configure_caldav'), data)
+        # Connection check and purge
+        self.assertEqual(len(callbacks), 2)
+        with self.captureOnCommitCallbacks() as callbacks:
+            self.client.post(reverse('configure_caldav'), data)
+        self.assertEqual(len(callbacks), 1)
+
+    def test_new_server_forgets_the_calendar(self):
+        data = {'caldav_url': 'https://other.example.com/dav/', 'caldav_username': 'alice',
+                'caldav_password': 'secret', 'push_enabled': 'on'}
+        with self.captureOnCommitCallbacks() as callbacks:
+            self.client.post(reverse('configure_caldav'), data)
+        self.assertEqual(len(callbacks), 1)
+        self.config.refresh_from_db()
+        self.assertEqual(self.config.validation_status, CalendarConfig.VALIDATION_PENDING)
+        self.assertEqual(self.config.calendar_url, '')
+        self.assertEqual(self.config.discovered_calendars, [])
+
+        # Unchanged credentials keep the calendar
+        CalendarConfig.objects.filter(pk=self.config.pk).update(calendar_url='https://other.example.com/dav/cal/')
+        self.client.post(reverse('configure_caldav'), dict(data, push_enabled=''))
+        self.config.refresh_from_db()
+        self.assertEqual(self.config.calendar_url, 'https://other.example.com/dav/cal/')
+
+
+class CalendarFeedTests(TestCase):
+    def setUp(self):
+        # Feeds are cached by profile PK and version, which repeat between tests
+        cache.clear()
+        self.user_profile = create_user('alice', sheet_name='Alice').userprofile
+        create_sheet_event('evt-1', 'Alice')
+        create_sheet_event('evt-2', 'Bob')
+        self.url = reverse('calendar_feed', args=[self.user_profile.get_feed_token()])
+
+    def test_feed(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'text/calendar; charset=utf-8')
+        body = b''.join(response.streaming_content).decode('utf-8')
+        self.assertEqual(body.count('BEGIN:VEVENT'), 1)
+        self.assertIn('SUMMARY:Event evt-1', body)
+        self.assertEqual(body.count('DTSTAMP:'), 1)
+        # Served from the cache the second time
+        response = self.client.get(self.url)
+        self.assertEqual(response.content.decode('utf-8'), body)
+
+    def test_not_modified_until_events_change(self):
+        etag = self.client.get(self.url)['ETag']
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        create_sheet_event('evt-3', 'Alice')
+        self.user_profile.bump_events_version()
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(b''.join(response.streaming_content).decode('utf-8').count('BEGIN:VEVENT'), 2)
+
+    def test_unknown_token(self):
+        self.assertEqual(self.client.get(reverse('calendar_feed', args=['nope'])).status_code, 404)
+
+
+class MetricsTests(TestCase):
+    def test_render_prometheus(self):
+        recorder = MetricsRecorder(buckets=(0.1, 1.0))
+        for value in (0.05, 0.5, 5.0):
+            recorder.observe('cal_sync_span_duration_seconds', value, phase='caldav')
+        recorder.inc('cal_sync_rows_total', 3, outcome='say "hi"\\\n')
+        lines = render_prometheus({'last_run': recorder.report()}).splitlines()
+
+        self.assertIn('# TYPE cal_sync_span_duration_seconds histogram', lines)
+        labels = 'phase="caldav",source="last_run"'
+        buckets = [line for line in lines if line.startswith('cal_sync_span_duration_seconds_bucket')]
+        self.assertEqual(buckets, [
+            f'cal_sync_span_duration_seconds_bucket{{le="0.1",{labels}}} 1',
+            f'cal_sync_span_duration_seconds_bucket{{le="1.0",{labels}}} 2',
+            f'cal_sync_span_duration_seconds_bucket{{le="+Inf",{labels}}} 3',
+        ])
+        self.assertIn(f'cal_sync_span_duration_seconds_count{{{labels}}} 3', lines)
+        self.assertIn(f'cal_sync_span_duration_seconds_sum{{{labels}}} 5.55', lines)
+        self.assertIn('cal_sync_rows_total{outcome="say \\"hi\\"\\\\\\n",source="last_run"} 3', lines)
+
+    def test_write_report_replaces_file(self):
+        recorder = MetricsRecorder()
+        recorder.inc('cal_sync_rows_total')
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'metrics.json')
+            with open(path, 'w') as report_file:
+                report_file.write('old')
+            recorder.write_report(path)
+            self.assertEqual(os.listdir(directory), ['metrics.json'])
+            with open(path) as report_file:
+                self.assertEqual(json.load(report_file)['counters'][0]['value'], 1)
+
+
+class SyncQueryBudgetTests(QueryBudgetMixin, TestCase):
+    def setUp(self):
+        self.command = PollSheetCommand(stdout=io.StringIO())
+        self.caldav_server = FakeCalDAVServer().start()
+        self.addCleanup(self.caldav_server.stop)
+
+    def test_upsert(self):
+        defaults = {
+            'title': 'Early shift', 'description': '',
+            'start_time': timezone.now(), 'end_time': timezone.now(),
+            'person1_name': 'Alice', 'person2_name': None,
+            'person3_name': None, 'person4_name': None,
+            'source_id': SheetSource.objects.create(spreadsheet_id='sheet-1').pk,
+        }
+        with self.assertQueryBudget(2):
+            self.command._upsert_sheet_event('evt-1', defaults, set())
+        # Unchanged rows are only read
+        with self.assertQueryBudget(1):
+            sheet_event, outcome = self.command._upsert_sheet_event('evt-1', defaults, set())
+        self.assertEqual(outcome, 'unchanged')
+
+    def test_sync_to_users_is_constant_per_user(self):
+        for i in range(5):
+            create_user(f'user{i}', sheet_name=f'Person {i}', caldav_server=self.caldav_server)
+        sheet_events = [create_sheet_event(f'evt-{i}', *[f'Person {i}' for i in range(4)], days=i)
+                        for i in range(10)]
+        # Bindings with profile, user and config in one query, then per user and
+        # regardless of the number of events: the claim (select, insert,
+        # select) and the bookkeeping (savepoint, update, release)
+        with self.assertQueryBudget(1 + 4 * 6):
+            self.command._sync_sheet_events_to_users_calendars(sheet_events)
+        self.assertEqual(UserCalDAVEvent.objects.count(), 40)
+        self.assertEqual(len(self.caldav_server.resources), 40)
+        # Updates write in place, without reading the events first
+        self.caldav_server.reset_counters()
+        self.command._sync_sheet_events_to_users_calendars(sheet_events)
+        self.assertEqual(len(self.caldav_server.resources), 40)
+        self.assertEqual(self.caldav_server.requests['PUT'], 40)
+        self.assertEqual(self.caldav_server.requests['REPORT'], 0)
+
+
+@override_settings(CALDAV_BATCH_WORKERS=4)
+class CalDAVBatchTests(TestCase):
+    def setUp(self):
+        self.caldav_server = FakeCalDAVServer().start()
+        self.addCleanup(self.caldav_server.stop)
+        self.caldav_service = CalDAVService(
+            self.caldav_server.user_url('alice'), 'alice', 'secret',
+            calendar_url=self.caldav_server.calendar_url('alice'))
+        self.sheet_events = [create_sheet_event(f'evt-{i}', 'Alice', days=i) for i in range(6)]
+
+    def test_requests_count_towards_the_callers_unit(self):
+        profiler.start()
+        self.addCleanup(profiler.stop)
+        with profiler.unit('user', 'alice') as stats:
+            results = self.caldav_service.put_events(
+                [(f'uid-{sheet_event.pk}', sheet_event) for sheet_event in self.sheet_events])
+        self.assertTrue(all(result.ok for result in results))
+        self.assertEqual(self.caldav_server.requests['PUT'], 6)
+        self.assertEqual(stats.http_calls, self.caldav_server.total_requests)
+
+    def test_delete_finds_events_stored_under_other_names(self):
+        for sheet_event in self.sheet_events[:2]:
+            self.caldav_service.create_event(sheet_event, f'uid-{sheet_event.pk}')
+        # e.g. written by an older client, the server named it differently
+        calendar_path = '/alice/calendar/'
+        old_path = next(path for path in self.caldav_server.resources
+                        if path.startswith(calendar_path) and f'uid-{self.sheet_events[0].pk}' in path)
+        self.caldav_server.resources[f'{calendar_path}renamed.ics'] = self.caldav_server.resources.pop(old_path)
+
+        results = self.caldav_service.delete_events(
+            [f'uid-{sheet_event.pk}' for sheet_event in self.sheet_events[:3]])
+        self.assertTrue(all(result.ok for result in results))
+        self.assertEqual(self.caldav_server.resources, {})
+
+    def test_put_replaces_events_stored_under_other_names(self):
+        sheet_event = self.sheet_events[0]
+        self.caldav_service.create_event(sheet_event, f'uid-{sheet_event.pk}')
+        calendar_path = '/alice/calendar/'
+        old_path = next(path for path in self.caldav_server.resources
+                        if path.startswith(calendar_path) and f'uid-{sheet_event.pk}' in path)
+        self.caldav_server.resources[f'{calendar_path}renamed.ics'] = self.caldav_server.resources.pop(old_path)
+        sheet_event.title = 'Renamed shift'
+        sheet_event.save()
+
+        [result] = self.caldav_service.put_events([(f'uid-{sheet_event.pk}', sheet_event)])
+        self.assertTrue(result.ok)
+        self.assertEqual(list(self.caldav_server.resources), [f'{calendar_path}renamed.ics'])
+        self.assertIn('Renamed shift', self.caldav_server.resources[f'{calendar_path}renamed.ics'])
+
+
+class RecurrenceDetectionTests(TestCase):
+    def weekly(self, event_id, week, title='Early shift', description=''):
+        start_time = timezone.make_aware(datetime.datetime(2026, 3, 2, 6, 0)) + datetime.timedelta(weeks=week)
+        return SheetEvent(event_id_in_sheet=event_id, title=title, description=description,
+                          start_time=start_time, end_time=start_time + datetime.timedelta(hours=8),
+                          person1_name='Alice', person2_name='Bob')
+
+    def test_weekly_series_with_gap(self):
+        events = [self.weekly(f'evt-{week}', week) for week in (0, 1, 3, 4, 5)]
+        [series] = detect_series(events)
+        self.assertEqual(series.interval_days, 7)
+        self.assertEqual(series.count, 6)
+        # Same wall clock time after the DST change on 29 March
+        self.assertEqual([timezone.localtime(exdate).isoformat() for exdate in series.exdates],
+                         ['2026-03-16T06:00:00+01:00'])
+
+    def test_different_titles_and_sparse_events_are_not_collapsed(self):
+        events = [self.weekly('evt-0', 0), self.weekly('evt-1', 1, title='Late shift'),
+                  self.weekly('evt-2', 2), self.weekly('evt-9', 9)]
+        self.assertEqual(detect_series(events), [])
+
+    def test_override_description(self):
+        events = [self.weekly(f'evt-{week}', week) for week in range(4)]
+        events.append(self.weekly('evt-4', 4, description='Bring keys'))
+        [series] = detect_series(events)
+        self.assertEqual(series.description, '')
+        self.assertEqual(len(series.events), 5)
+
+
+@override_settings(SYNC_METRICS_FILE=None, SYNC_RUN_LOG_FILE=None)
+class RecurringSyncTests(TestCase):
+    def setUp(self):
+        self.caldav_server = FakeCalDAVServer().start()
+        self.addCleanup(self.caldav_server.stop)
+        create_user('alice', sheet_name='Alice', caldav_server=self.caldav_server)
+        create_user('bob', sheet_name='Bob', caldav_server=self.caldav_server)
+        # Weekly shift with a gap in week 2 and a note in week 3, plus a one-off event
+        self.sheet = [list(HEADERS)]
+        for week in (0, 1, 3, 4):
+            self.sheet.append(self.row(f'evt-{week}', week, 'Early shift', 'Bring keys' if week == 3 else ''))
+        self.sheet.append(self.row('evt-once', 1, 'Briefing', '', hour=14))
+
+    def row(self, event_id, week, title, description, hour=6):
+        start = datetime.datetime(2026, 3, 2, hour, 0) + datetime.timedelta(weeks=week)
+        return [event_id, title, description, start.strftime(DATE_FORMAT),
+                (start + datetime.timedelta(hours=8)).strftime(DATE_FORMAT), 'Alice', 'Bob', '', '']
+
+    def poll(self, **options):
+        call_command('poll_sheet', spreadsheet_id='sheet-1', sheets_service=SyntheticSheetsService(self.sheet),
+                     stdout=io.StringIO(), **options)
+
+    def calendar(self, username):
+        prefix = f'/{username}/calendar/'
+        return [data for path, data in self.caldav_server.resources.items() if path.startswith(prefix)]
+
+    def series_data(self, username):
+        [data] = [data for data in self.calendar(username) if 'RRULE:' in data]
+        return data
+
+    def test_series_per_user(self):
+        self.poll(collapse_recurring=True)
+        self.assertEqual(EventSeries.objects.count(), 1)
+        self.assertEqual(UserCalDAVSeries.objects.count(), 2)
+        for username in ('alice', 'bob'):
+            # The series and the one-off event
+            self.assertEqual(len(self.calendar(username)), 2)
+            data = self.series_data(username)
+            self.assertIn('RRULE:FREQ=WEEKLY;COUNT=5;INTERVAL=1', data)
+            self.assertIn('EXDATE;TZID=Europe/Berlin:20260316T060000', data)
+            self.assertIn('RECURRENCE-ID;TZID=Europe/Berlin:20260323T060000', data)
+            self.assertIn('DESCRIPTION:Bring keys', data)
+            self.assertIn('BEGIN:VTIMEZONE', data)
+
+        # The note is removed, the series is rewritten in place without the override
+        self.sheet[3][2] = ''
+        self.poll(collapse_recurring=True)
+        for username in ('alice', 'bob'):
+            self.assertEqual(len(self.calendar(username)), 2)
+            self.assertNotIn('RECURRENCE-ID', self.series_data(username))
+
+    def test_dropping_the_option_dissolves_series(self):
+        self.poll(collapse_recurring=True)
+        self.poll()
+        self.assertEqual(EventSeries.objects.count(), 0)
+        self.assertEqual(UserCalDAVSeries.objects.count(), 0)
+        self.assertEqual(UserCalDAVEvent.objects.count(), 10)
+        for username in ('alice', 'bob'):
+            calendar = self.calendar(username)
+            self.assertEqual(len(calendar), 5)
+            self.assertFalse(any('RRULE:' in data for data in calendar))
+
+    def test_series_are_scoped_to_their_sheet(self):
+        # Same shift on Mondays in one sheet and on Tuesdays in another
+        other_sheet = [list(HEADERS)] + [
+            self.row(f'evt-{week}', week, 'Early shift', '') for week in range(4)]
+        for row in other_sheet[1:]:
+            start = datetime.datetime.strptime(row[3], DATE_FORMAT) + datetime.timedelta(days=1)
+            row[3] = start.strftime(DATE_FORMAT)
+            row[4] = (start + datetime.timedelta(hours=8)).strftime(DATE_FORMAT)
+        self.poll(collapse_recurring=True)
+        call_command('poll_sheet', spreadsheet_id='sheet-2', collapse_recurring=True,
+                     sheets_service=SyntheticSheetsService(other_sheet), stdout=io.StringIO())
+        self.poll(collapse_recurring=True)
+
+        self.assertEqual(EventSeries.objects.count(), 2)
+        for series in EventSeries.objects.all():
+            self.assertEqual(series.occurrences.count(), 4)
+            self.assertEqual({event.source_id for event in series.occurrences.all()}, {series.source_id})
+        series_data = [data for data in self.calendar('alice') if 'RRULE:' in data]
+        self.assertEqual(len(series_data), 2)
+
+    def test_purge_user_calendar(self):
+        self.poll(collapse_recurring=True)
+        summary = purge_user_calendar(UserProfile.objects.get(user__username='alice').pk)
+        self.assertEqual(summary['caldav_deleted'], 2)
+        self.assertEqual(self.calendar('alice'), [])
+        self.assertEqual(len(self.calendar('bob')), 2)
+        self.assertFalse(UserCalDAVEvent.objects.filter(user_profile__user__username='alice').exists())
+        self.assertFalse(UserCalDAVSeries.objects.filter(user_profile__user__username='alice').exists())
+
+    def test_incremental_run_after_collapse(self):
+        # e.g. cron collapses, a change notification then syncs without the option
+        self.poll(collapse_recurring=True)
+        self.poll(incremental=True)
+        self.assertEqual(EventSeries.objects.count(), 0)
+        self.assertEqual(UserCalDAVEvent.objects.count(), 10)
+        for username in ('alice', 'bob'):
+            calendar = self.calendar(username)
+            self.assertEqual(len(calendar), 5)
+            self.assertFalse(any('RRULE:' in data for data in calendar))
+
+
+@override_settings(SHEET_NOTIFICATION_DEBOUNCE_SECONDS=0, SYNC_METRICS_FILE=None, SYNC_RUN_LOG_FILE=None)
+class DriveNotificationTests(TestCase):
+    def setUp(self):
+        self.source = SheetSource.objects.create(
+            spreadsheet_id='sheet-1', channel_id='channel-1', channel_token='secret')
+
+    def notify(self, token='secret', state='update', channel_id='channel-1'):
+        with self.captureOnCommitCallbacks() as callbacks:
+            response = self.client.post(
+                reverse('drive_notifications'), HTTP_X_GOOG_CHANNEL_ID=channel_id,
+                HTTP_X_GOOG_CHANNEL_TOKEN=token, HTTP_X_GOOG_RESOURCE_STATE=state)
+        self.source.refresh_from_db()
+        return response, callbacks
+
+    def test_change_requests_sync(self):
+        response, callbacks = self.notify()
+        self.assertEqual(response.status_code, 200)
+        # Synced by the sync_sheet_sources command, not in the web process
+        self.assertEqual(callbacks, [])
+        requested_at = self.source.sync_requested_at
+        self.assertIsNotNone(requested_at)
+        # A burst keeps the first request and postpones the sync
+        self.notify()
+        self.assertEqual(self.source.sync_requested_at, requested_at)
+        self.assertGreater(self.source.last_notified_at, requested_at)
+
+    def test_rejected_notifications(self):
+        self.assertEqual(self.notify(token='wrong')[0].status_code, 403)
+        self.assertEqual(self.notify(channel_id='unknown')[0].status_code, 404)
+        # Channel opened, nothing changed yet
+        response, callbacks = self.notify(state='sync')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(callbacks, [])
+        self.assertIsNone(self.source.sync_requested_at)
+
+    def test_sync_due_sources(self):
+        self.notify()
+        sheet = generate_sheet(rows=5, assignees=2)
+        self.assertEqual(sync_due_sources(SyntheticSheetsService(sheet)), ['sheet-1'])
+        self.source.refresh_from_db()
+        self.assertIsNone(self.source.sync_requested_at)
+        self.assertIsNotNone(self.source.last_synced_at)
+        self.assertEqual(SheetEvent.objects.filter(source=self.source).count(), 5)
+        # Nothing pending any more
+        self.assertEqual(sync_due_sources(SyntheticSheetsService(sheet)), [])
+
+
+class SheetSourceLeaseTests(TestCase):
+    def test_lease(self):
+        source = SheetSource.objects.create(spreadsheet_id='sheet-1')
+        duration = datetime.timedelta(minutes=5)
+        self.assertTrue(source.acquire_lease('run-1', duration))
+        self.assertFalse(source.acquire_lease('run-2', duration))
+        # Renewal by the holder
+        self.assertTrue(source.acquire_lease('run-1', duration))
+        source.release_lease('run-2')
+        self.assertFalse(source.acquire_lease('run-2', duration))
+        source.release_lease('run-1')
+        self.assertTrue(source.acquire_lease('run-2', duration))
+        # Expired leases of crashed runs are taken over
+        SheetSource.objects.update(lease_expires_at=timezone.now())
+        self.assertTrue(source.acquire_lease('run-3', duration))
+
+
+@override_settings(SYNC_METRICS_FILE=None, SYNC_RUN_LOG_FILE=None)
+class ConcurrentPollStressTests(TransactionTestCase):
+    """Several pollers and web readers at once on the on-disk SQLite test database."""
+    POLLERS_PER_SHEET = 3
+    READERS = 2
+
+    def setUp(self):
+        self.caldav_server = FakeCalDAVServer(latency=0.002).start()
+        self.addCleanup(self.caldav_server.stop)
+        self.users = [create_user(f'user{i}', sheet_name=f'Person {i}', caldav_server=self.caldav_server)
+                      for i in range(4)]
+
+    def run_concurrently(self, targets):
+        barrier = threading.Barrier(len(targets))
+        errors = []
+
+        def run(target):
+            try:
+                barrier.wait()
+                target()
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=run, args=(target,)) for target in targets]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+
+    def poller(self, spreadsheet_id, sheet):
+        return lambda: call_command(
+            'poll_sheet', spreadsheet_id=spreadsheet_id,
+            sheets_service=SyntheticSheetsService(sheet), stdout=io.StringIO())
+
+    def reader(self, user):
+        def read():
+            client = Client()
+            client.force_login(user)
+            for i in range(10):
+                self.assertEqual(client.get(reverse('dashboard')).status_code, 200)
+        return read
+
+    def assertNoDuplicates(self):
+        mapped = UserCalDAVEvent.objects.count()
+        self.assertEqual(mapped, UserCalDAVEvent.objects.values('user_profile', 'sheet_event').distinct().count())
+        self.assertEqual(len(self.caldav_server.resources), mapped)
+
+    def test_overlapping_polls(self):
+        # Both sheets use the same event IDs
+        sheets = {'sheet-a': generate_sheet(30, assignees=4),
+                  'sheet-b': generate_sheet(30, assignees=4, seed=1)}
+        targets = [self.poller(spreadsheet_id, sheet) for spreadsheet_id, sheet in sheets.items()
+                   for i in range(self.POLLERS_PER_SHEET)]
+        targets += [self.reader(user) for user in self.users[:self.READERS]]
+        self.run_concurrently(targets)
+
+        self.assertEqual(SheetEvent.objects.count(), 60)
+        self.assertFalse(SheetSource.objects.exclude(lease_owner='').exists())
+        self.assertNoDuplicates()
+
+    def test_claiming_without_lease(self):
+        # Runs overlapping regardless of the lease, e.g. after it expired
+        for i in range(10):
+            create_sheet_event(f'evt-{i}', 'Person 0', 'Person 1', days=i)
+        sheet_events = list(SheetEvent.objects.all())
+
+        def sync():
+            command = PollSheetCommand(stdout=io.StringIO())
+            command._sync_sheet_events_to_users_calendars(sheet_events)
+
+        self.run_concurrently([sync] * 4)
+        self.assertEqual(UserCalDAVEvent.objects.count(), 20)
+        self.assertNoDuplicates()
+
+
+@override_settings(SYNC_METRICS_FILE=None)
+class PollOutputTests(TestCase):
+    def setUp(self):
+        self.caldav_server = FakeCalDAVServer().start()
+        self.addCleanup(self.caldav_server.stop)
+        create_user('alice', sheet_name='Person 0', caldav_server=self.caldav_server)
+        self.sheet = generate_sheet(20, assignees=2)
+        self.sheet[5][3] = 'not a date'
+        run_log_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(run_log_dir.cleanup)
+        self.run_log = os.path.join(run_log_dir.name, 'runs.jsonl')
+
+    def poll(self, spreadsheet_id='sheet-1', **options):
+        stdout = io.StringIO()
+        call_command('poll_sheet', spreadsheet_id=spreadsheet_id, run_log=self.run_log,
+                     sheets_service=SyntheticSheetsService(self.sheet), stdout=stdout, **options)
+        return stdout.getvalue().splitlines()
+
+    def test_summary_and_errors_only(self):
+        lines = self.poll()
+        self.assertEqual(len(lines), 2)
+        self.assertIn('Error processing row 6', lines[0])
+        self.assertIn('20 rows (19 created, 0 updated, 0 unchanged, 0 skipped, 1 invalid)', lines[1])
+
+    def test_sheets_sharing_event_ids(self):
+        self.assertIn('(19 created,', self.poll()[-1])
+        self.assertIn('(19 created,', self.poll('sheet-2')[-1])
+        self.assertEqual(SheetEvent.objects.count(), 38)
+        # Neither poll takes over the other sheet's events
+        self.assertIn('(0 created, 0 updated, 19 unchanged,', self.poll()[-1])
+        self.assertIn('0 removed', self.poll('sheet-2')[-1])
+
+    def test_verbose(self):
+        # Per row and user detail
+        self.assertGreater(len(self.poll(verbosity=2)), 20)
+
+    def test_run_log(self):
+        self.poll()
+        with open(self.run_log) as run_log:
+            entries = [json.loads(line) for line in run_log]
+        self.assertTrue(all(tuple(entry) == RUN_LOG_FIELDS for entry in entries))
+        self.assertEqual(len({entry['run'] for entry in entries}), 1)
+        [error] = [entry for entry in entries if entry['operation'] == 'row' and entry['outcome'] == 'error']
+        self.assertEqual(error['row'], 6)
+        creates = [entry for entry in entries if entry['operation'] == 'create']
+        self.assertTrue(creates)
+        self.assertTrue(all(entry['user'] == 'alice' and entry['duration_ms'] is not None for entry in creates))
+        self.assertEqual(entries[-1]['operation'], 'run')
+
+    def test_run_log_rotated_externally(self):
+        self.poll()
+        os.rename(self.run_log, f'{self.run_log}.1')
+        self.poll()
+        runs = []
+        for path in (f'{self.run_log}.1', self.run_log):
+            with open(path) as run_log:
+                runs.append({json.loads(line)['run'] for line in run_log})
+        self.assertEqual(len(runs[0]), 1)
+        self.assertEqual(len(runs[1]), 1)
+        self.assertNotEqual(runs[0], runs[1])
+
+
+class AdminTests(QueryBudgetMixin, TestCase):
+    def setUp(self):
+        self.caldav_server = FakeCalDAVServer().start()
+        self.addCleanup(self.caldav_server.stop)
+        for i in range(3):
+            create_user(f'user{i}', sheet_name=f'Person {i}', caldav_server=self.caldav_server)
+        self.sheet_events = [create_sheet_event(f'evt-{i}', 'Person 0', 'Person 1', 'Person 2', days=i)
+                             for i in range(10)]
+        resync_sheet_events([sheet_event.pk for sheet_event in self.sheet_events])
+        self.client.force_login(User.objects.create_superuser('admin', password='secret'))
+
+    def test_changelists_do_not_query_per_row(self):
+        # session, user, user filter choices, size estimate, exact count of the small table, page
+        with self.assertQueryBudget(6):
+            response = self.client.get(reverse('admin:core_usercaldavevent_changelist'))
+        self.assertContains(response, 'user2')
+        # session, user, user filter choices, count, page
+        with self.assertQueryBudget(5):
+            self.client.get(reverse('admin:core_usereventbinding_changelist'))
+        with self.assertQueryBudget(5):
+            self.client.get(reverse('admin:core_sheetevent_changelist'))
+
+    def test_estimated_count(self):
+        with mock.patch('core.admin.ESTIMATED_COUNT_THRESHOLD', 5):
+            UserCalDAVEvent.objects.filter(user_profile__user__username='user0').order_by('pk')[0].delete()
+            response = self.client.get(reverse('admin:core_usercaldavevent_changelist'))
+            # The estimate does not notice the deleted row
+            self.assertEqual(response.context['cl'].result_count, 30)
+            # Filtered lists are counted
+            response = self.client.get(reverse('admin:core_usercaldavevent_changelist'),
+                                       {'user_profile': UserProfile.objects.get(user__username='user1').pk})
+            self.assertEqual(response.context['cl'].result_count, 10)
+
+    def test_actions_run_after_commit(self):
+        with self.captureOnCommitCallbacks() as callbacks:
+            response = self.client.post(reverse('admin:core_sheetevent_changelist'), {
+                'action': 'resync_selected_sheet_events',
+                '_selected_action': [sheet_event.pk for sheet_event in self.sheet_events[:2]],
+            })
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(len(callbacks), 1)
+
+    def test_resync_and_purge(self):
+        self.caldav_server.resources.clear()
+        summary = resync_sheet_events([sheet_event.pk for sheet_event in self.sheet_events])
+        self.assertEqual(summary['caldav_written'], 30)
+        self.assertEqual(len(self.caldav_server.resources), 30)
+
+        user_caldav_events = UserCalDAVEvent.objects.filter(user_profile__user__username='user0')
+        summary = purge_user_caldav_events(list(user_caldav_events.values_list('pk', flat=True)))
+        self.assertEqual(summary['caldav_deleted'], 10)
+        self.assertFalse(user_caldav_events.exists())
+
+        versions = dict(UserProfile.objects.values_list('user__username', 'events_version'))
+        summary = purge_sheet_events([sheet_event.pk for sheet_event in self.sheet_events[:4]])
+        self.assertEqual(summary['caldav_deleted'], 8)
+        self.assertEqual(summary['events_deleted'], 4)
+        self.assertEqual(len(self.caldav_server.resources), 12)
+        self.assertEqual(SheetEvent.objects.count(), 6)
+        # Feeds and dashboards of the assigned users are invalidated
+        for username, events_version in UserProfile.objects.values_list('user__username', 'events_version'):
+            self.assertEqual(events_version, versions[username] + 1)
+
+    def test_resync_selected_mappings_only(self):
+        self.caldav_server.resources.clear()
+        user_caldav_events = UserCalDAVEvent.objects.filter(
+            user_profile__user__username='user1').order_by('pk')[:3]
+        summary = resync_user_caldav_events([mapping.pk for mapping in user_caldav_events])
+        self.assertEqual(summary['caldav_written'], 3)
+        self.assertEqual(len(self.caldav_server.resources), 3)
+        self.assertTrue(all(path.startswith('/user1/') for path in self.caldav_server.resources))
+
+    def test_purge_reports_skipped_occurrences(self):
+        sheet_event = self.sheet_events[0]
+        sheet_event.series = EventSeries.objects.create(
+            series_key='key', title=sheet_event.title, start_time=sheet_event.start_time,
+            end_time=sheet_event.end_time, interval_days=7, count=1)
+        sheet_event.save()
+        response = self.client.post(reverse('admin:core_sheetevent_changelist'), {
+            'action': 'purge_selected_sheet_events',
+            '_selected_action': [sheet_event.pk for sheet_event in self.sheet_events[:3]],
+        }, follow=True)
+        self.assertContains(response, 'Purging 2 events in the background, 1 occurrences of recurring series are skipped.')
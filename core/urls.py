@@ -4,5 +4,9 @@ from . import views
 urlpatterns = [
     path('dashboard/', views.dashboard, name='dashboard'),
     path('caldav/configure/', views.configure_caldav, name='configure_caldav'),
+    path('caldav/status/', views.caldav_status, name='caldav_status'),
     path('binding/configure/', views.configure_binding, name='configure_binding'),
+    path('feed/<str:token>.ics', views.calendar_feed, name='calendar_feed'),
+    path('metrics/', views.prometheus_metrics, name='metrics'),
+    path('drive/notifications/', views.drive_notifications, name='drive_notifications'),
 ]
@@ -1,39 +1,119 @@
+import datetime
+import hashlib
+import hmac
+import json
+import os
+
 from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib.auth.decorators import login_required
 from django.contrib import messages
-from django.db.models import Q
-from .models import UserProfile, CalendarConfig, UserEventBinding, SheetEvent, UserCalDAVEvent
+from django.conf import settings
+from django.core.cache import cache
+from django.core.paginator import Paginator
+from django.db.models.functions import Coalesce
+from django.http import Http404, HttpResponse, HttpResponseForbidden, JsonResponse, StreamingHttpResponse
+from django.urls import reverse
+from django.utils import timezone
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST, require_safe
+from .models import UserProfile, CalendarConfig, UserEventBinding, SheetEvent, UserCalDAVEvent, SheetSource
 from .forms import CalDAVConfigForm, UserEventBindingForm
-from .services import CalDAVService  # For testing connection
+from .metrics import metrics, render_prometheus
+from .services import iter_ics_feed
+from .tasks import enqueue_calendar_purge, enqueue_calendar_validation
+
+# Longer windows are cut to ten years, huge ones overflow the date arithmetic
+DASHBOARD_MAX_WINDOW_DAYS = 3650
 
 
 @login_required
 def dashboard(request):
-    user_profile, created = UserProfile.objects.get_or_create(
-        user=request.user)
-    caldav_config = CalendarConfig.objects.filter(
-        user_profile=user_profile).first()
+    user_profile, created = UserProfile.objects.select_related(
+        'calendarconfig').get_or_create(user=request.user)
+    try:
+        caldav_config = user_profile.calendarconfig
+    except CalendarConfig.DoesNotExist:
+        caldav_config = None
+
+    # Only events overlapping the window are listed unless ?window=all.
+    # Parameters are normalised, they end up in the ETag and the cache key.
+    window_start = timezone.localdate()
+    window = request.GET.get('window')
+    if window == 'all':
+        window_days = None
+    elif window and window.isdigit():
+        window_days = max(1, min(int(window), DASHBOARD_MAX_WINDOW_DAYS))
+        window = str(window_days)
+    else:
+        window = None
+        window_days = getattr(settings, 'DASHBOARD_WINDOW_DAYS', 30)
+    page = request.GET.get('page', '')
+    page_number = int(page) if page.isdigit() and int(page) > 0 else 1
+
+    # The page only changes when the poll or the user changes this profile's
+    # events version, so unchanged pages are answered with a 304.
+    # Flash messages are rendered once, those responses are never conditional.
+    # The page also holds a CSRF token, its secret is rotated on login.
+    csrf_hash = hashlib.sha256(request.META.get('CSRF_COOKIE', '').encode('utf-8')).hexdigest()[:16]
+    etag = f'"{user_profile.pk}-{user_profile.events_version}-{window_start}-{window}-{page_number}-{csrf_hash}"'
+    last_modified = None
+    if user_profile.events_changed_at:
+        last_modified = int(user_profile.events_changed_at.timestamp())
+    if not len(messages.get_messages(request)):
+        response = get_conditional_response(
+            request, etag=etag, last_modified=last_modified)
+        if response is not None:
+            return response
+
     user_binding = UserEventBinding.objects.filter(
         user_profile=user_profile).first()
 
-    assigned_events = []
+    events_page = None
     if user_binding and user_binding.sheet_name:
-        # Dynamically query all person fields
-        query = Q(person1_name=user_binding.sheet_name) | \
-            Q(person2_name=user_binding.sheet_name) | \
-            Q(person3_name=user_binding.sheet_name) | \
-            Q(person4_name=user_binding.sheet_name)
-
-        assigned_events = SheetEvent.objects.filter(
-            query).order_by('start_time')
+        cache_key = f'core:dashboard:{user_profile.pk}:{user_profile.events_version}:{window_start}:{window_days}:{page_number}'
+        events_page = cache.get(cache_key)
+        if events_page is None:
+            # Dynamically query all person fields
+            assigned_events = SheetEvent.objects.assigned_to(
+                user_binding.sheet_name).order_by('start_time')
+            if window_days is not None:
+                window_start_time = timezone.make_aware(
+                    datetime.datetime.combine(window_start, datetime.time.min))
+                assigned_events = assigned_events.filter(
+                    end_time__gte=window_start_time,
+                    start_time__lt=window_start_time + datetime.timedelta(days=window_days))
+            paginator = Paginator(
+                assigned_events.values('title', 'description', 'start_time', 'end_time'),
+                getattr(settings, 'DASHBOARD_EVENTS_PER_PAGE', 25))
+            page = paginator.get_page(page_number)
+            events_page = {
+                'events': list(page),
+                'number': page.number,
+                'num_pages': paginator.num_pages,
+                'count': paginator.count,
+            }
+            cache.set(cache_key, events_page,
+                      getattr(settings, 'DASHBOARD_CACHE_TIMEOUT', 60 * 15))
 
     context = {
         'user_profile': user_profile,
         'caldav_config': caldav_config,
         'user_binding': user_binding,
-        'assigned_events': assigned_events,
+        'assigned_events': events_page['events'] if events_page else [],
+        'events_page': events_page,
+        'window': window,
+        'window_days': window_days,
+        'feed_url': request.build_absolute_uri(
+            reverse('calendar_feed', args=[user_profile.get_feed_token()])),
     }
-    return render(request, 'core/dashboard.html', context)
+    response = render(request, 'core/dashboard.html', context)
+    response['ETag'] = etag
+    if last_modified is not None:
+        response['Last-Modified'] = http_date(last_modified)
+    patch_cache_control(response, private=True, no_cache=True)
+    return response
 
 
 @login_required
@@ -47,29 +127,47 @@ def configure_caldav(request):
         if form.is_valid():
             config = form.save(commit=False)
             config.user_profile = user_profile  # Ensure user_profile is set if it's new
-
-            # Test CalDAV connection before saving
-            try:
-                caldav_service = CalDAVService(
-                    config.caldav_url,
-                    config.caldav_username,
-                    config.caldav_password
-                )
-                # Attempt to connect and get a calendar (this will raise an exception on failure)
-                caldav_service.get_or_select_calendar()
-                config.save()
-                messages.success(
-                    request, 'CalDAV configuration saved and connection successful! Events will sync on next sheet poll.')
-                return redirect('dashboard')
-            except Exception as e:
-                messages.error(
-                    request, f'Failed to connect to CalDAV server: {e}')
+            # The connection is checked in the background, see caldav_status
+            config.validation_status = CalendarConfig.VALIDATION_PENDING
+            config.validation_error = ''
+            if {'caldav_url', 'caldav_username', 'caldav_password'}.intersection(form.changed_data):
+                # The old calendar may not exist on the new server or account,
+                # the poll discovers one until the check has picked it
+                config.calendar_url = ''
+                config.discovered_calendars = []
+            config.save()
+            enqueue_calendar_validation(config.pk)
+            # The dashboard shows the configuration
+            user_profile.bump_events_version()
+            messages.success(
+                request, 'CalDAV configuration saved. Checking the connection in the background...')
+            if 'push_enabled' in form.changed_data and not config.push_enabled:
+                # They would sit next to the feed's copies, never updated again
+                enqueue_calendar_purge(user_profile.pk)
+                messages.info(request, 'Removing the events written to your calendar in the background.')
+            return redirect('configure_caldav')
         else:
             messages.error(request, 'Please correct the errors below.')
     else:
         form = CalDAVConfigForm(instance=caldav_config)
 
-    return render(request, 'core/configure_caldav.html', {'form': form})
+    return render(request, 'core/configure_caldav.html', {'form': form, 'caldav_config': caldav_config})
+
+
+@login_required
+@require_safe
+def caldav_status(request):
+    """Status of the background CalDAV connection check, polled by the configuration form."""
+    status = CalendarConfig.objects.filter(user_profile__user=request.user).values(
+        'validation_status', 'validation_error', 'validated_at', 'discovered_calendars').first()
+    if status is None:
+        return JsonResponse({'status': None})
+    return JsonResponse({
+        'status': status['validation_status'],
+        'error': status['validation_error'],
+        'validated_at': status['validated_at'],
+        'calendars': status['discovered_calendars'],
+    })
 
 
 @login_required
@@ -84,6 +182,8 @@ def configure_binding(request):
             binding = form.save(commit=False)
             binding.user_profile = user_profile  # Ensure user_profile is set if it's new
             binding.save()
+            # A different name means a different set of assigned events
+            user_profile.bump_events_version()
             messages.success(request, 'Sheet name binding saved successfully!')
             return redirect('dashboard')
         else:
@@ -92,3 +192,104 @@ def configure_binding(request):
         form = UserEventBindingForm(instance=user_binding)
 
     return render(request, 'core/configure_binding.html', {'form': form})
+
+
+@require_safe
+def calendar_feed(request, token):
+    """
+    iCalendar subscription feed of the events assigned to a user.
+    Authenticated by the secret token in the URL, as calendar clients
+    can't log in. The body is cached until the poll changes the user's
+    events; clients revalidating with If-None-Match mostly get a 304.
+    """
+    user_profile = get_object_or_404(UserProfile, feed_token=token)
+    etag = f'"{user_profile.pk}-{user_profile.events_version}"'
+    last_modified = None
+    if user_profile.events_changed_at:
+        last_modified = int(user_profile.events_changed_at.timestamp())
+
+    response = get_conditional_response(
+        request, etag=etag, last_modified=last_modified)
+    if response is None:
+        cache_key = f'core:ics_feed:{user_profile.pk}:{user_profile.events_version}'
+        content = cache.get(cache_key)
+        if content is not None:
+            response = HttpResponse(content, content_type='text/calendar; charset=utf-8')
+        else:
+            response = StreamingHttpResponse(
+                _cached_stream(iter_ics_feed(_feed_events(user_profile)), cache_key),
+                content_type='text/calendar; charset=utf-8')
+        response['Content-Disposition'] = 'inline; filename="events.ics"'
+
+    response['ETag'] = etag
+    if last_modified is not None:
+        response['Last-Modified'] = http_date(last_modified)
+    return response
+
+
+def _feed_events(user_profile):
+    sheet_names = list(UserEventBinding.objects.filter(
+        user_profile=user_profile).values_list('sheet_name', flat=True))
+    if not sheet_names:
+        return []
+    return SheetEvent.objects.assigned_to(*sheet_names).order_by('start_time').iterator()
+
+
+def _cached_stream(chunks, cache_key):
+    """Passes chunks through and caches the whole body once it has been sent."""
+    sent = []
+    for chunk in chunks:
+        sent.append(chunk)
+        yield chunk
+    cache.set(cache_key, ''.join(sent),
+              getattr(settings, 'ICS_FEED_CACHE_TIMEOUT', 60 * 60 * 24))
+
+
+@require_safe
+def prometheus_metrics(request):
+    """
+    Sync timings and counters in the Prometheus text format: the report of
+    the last poll_sheet run plus what this web process recorded itself.
+    Readable by staff users or with the METRICS_TOKEN as bearer token.
+    """
+    token = getattr(settings, 'METRICS_TOKEN', None)
+    authorization = request.headers.get('Authorization', '')
+    if not (request.user.is_staff or
+            (token and hmac.compare_digest(authorization, f'Bearer {token}'))):
+        return HttpResponseForbidden()
+
+    reports = {}
+    metrics_file = getattr(settings, 'SYNC_METRICS_FILE', None)
+    if metrics_file and os.path.exists(metrics_file):
+        with open(metrics_file) as report_file:
+            reports['last_run'] = json.load(report_file)
+    reports['web'] = metrics.report()
+    return HttpResponse(render_prometheus(reports),
+                        content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+@csrf_exempt
+@require_POST
+def drive_notifications(request):
+    """
+    Receives Google Drive push notifications for watched spreadsheets.
+    Google posts the channel's ID and secret token as headers, the body is
+    empty. A change only marks the sheet for a sync, which the
+    sync_sheet_sources command runs once notifications have calmed down.
+    """
+    channel_id = request.headers.get('X-Goog-Channel-ID', '')
+    source = SheetSource.objects.filter(channel_id=channel_id).first() if channel_id else None
+    if source is None:
+        raise Http404('Unknown notification channel.')
+    token = request.headers.get('X-Goog-Channel-Token', '')
+    if not hmac.compare_digest(token, source.channel_token):
+        return HttpResponseForbidden()
+
+    # Sent once when the channel is opened
+    if request.headers.get('X-Goog-Resource-State') == 'sync':
+        return HttpResponse(status=200)
+
+    now = timezone.now()
+    SheetSource.objects.filter(pk=source.pk).update(
+        last_notified_at=now, sync_requested_at=Coalesce('sync_requested_at', now))
+    return HttpResponse(status=200)